@@ -0,0 +1,302 @@
+"""Large-canvas CloStOb generation.
+
+This file contains functions for generating CloStOb canvases much larger than a single scene (e.g. 2048x2048 and
+beyond), holding a grid of structured-object groups, tile by tile into memory-mapped arrays.
+
+Authors
+-------
+ * Mateus Riva (mateus.riva@telecom-paris.fr)"""
+#%%
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from torch.utils.data import Dataset
+
+from datasets.clostob.clostob_dataset import (load_dataset, base_dataset_fingerprint, draw_batch_placements,
+                                              batch_to_tensors, OUTPUTS, LABELMAP_DTYPE, BG_LABELMAP_DTYPE, CACHE_VERSION)
+
+# Side of the square tiles canvases are rendered by
+TILE_SIZE = 512
+
+
+def draw_canvas_placements(seed, base_dataset, canvas_dimensions: tuple, group_dimensions: tuple, fg_classes: list,
+                           fg_positions: list, position_translation: float, position_noise: float, rescale_classes: list,
+                           rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple, bg_classes: list,
+                           bg_amount: float, bg_bbox: tuple, rescale_levels=None, rng_scheme: str="legacy"):
+    """Draws the random placement parameters of a canvas, as a grid of structured-object groups.
+
+    The canvas is split into a grid of cells of `group_dimensions`, each holding one group: a CloStOb scene of
+    `group_dimensions`, drawn exactly as a single image would be with seed `seed * num_groups + group`. Since scene
+    elements never leave their scene, groups never overlap.
+
+    :param seed: Random number generator seed for this canvas.
+    :param canvas_dimensions: dimensions of the canvas.
+    :param group_dimensions: dimensions of each group cell; the canvas holds as many whole cells as fit, from the top left.
+    :return: a tuple (placements, group_origins) of the `draw_placements` arrays of every group, stacked along a first
+    group axis with coordinates on the canvas, and of the (G,2) top-left coordinates of each group cell. See
+    `generate_image` for the other parameters.
+    """
+    grid = np.array(canvas_dimensions) // group_dimensions
+    assert np.all(grid > 0), "The canvas ({}) must hold at least one group ({})".format(canvas_dimensions, group_dimensions)
+    group_origins = np.indices(grid).reshape(2, -1).T * group_dimensions
+    num_groups = len(group_origins)
+
+    placements = draw_batch_placements(seed * num_groups + np.arange(num_groups), base_dataset, group_dimensions, fg_classes,
+                                       fg_positions, position_translation, position_noise, rescale_classes, rescale_range,
+                                       occlusion_classes, occlusion_range, bg_classes, bg_amount, bg_bbox,
+                                       rescale_levels=rescale_levels, rng_scheme=rng_scheme)
+    # Moving every group to its cell
+    placements["bg_coords"] = placements["bg_coords"] + group_origins[:, None]
+    placements["fg_coords"] = placements["fg_coords"] + group_origins[:, None]
+    return placements, group_origins
+
+
+def canvas_elements(placements, base_dataset, fg_classes: list, omission_idxs: list=None):
+    """Lists the elements of a canvas in painting order (for each group, its bg elements then its fg elements), with
+    their boxes on the canvas.
+
+    :param placements: placements of the canvas groups, as given by `draw_canvas_placements`.
+    :param omission_idxs: If not None, fg_classes with indexes in omission_idxs are left out.
+    :return: a dict of per-element arrays: "boxes" (E,4) as (top, left, bottom, right), "classes", "indexes", "scales"
+    (NaN when not rescaled), "occlusions" (E,3) and "labels" (fg index + 1, or 0 for bg elements).
+    """
+    if omission_idxs is None: omission_idxs = []
+    num_groups, num_bg = placements["bg_classes"].shape
+    base_shape = np.array(base_dataset.image_shape)
+    fg_slots = [idx for idx in range(len(fg_classes)) if (idx+1) not in omission_idxs]
+    fg_scales = placements["fg_scales"][:, fg_slots]
+    # The rescaled shape follows `skimage.transform.rescale`
+    fg_shapes = np.where(np.isnan(fg_scales)[..., None], base_shape, np.maximum(np.round(np.nan_to_num(fg_scales)[..., None] * base_shape), 1)).astype(int)
+
+    elements = {"coords": np.concatenate([placements["bg_coords"], placements["fg_coords"][:, fg_slots]], axis=1),
+                "shapes": np.concatenate([np.broadcast_to(base_shape, (num_groups, num_bg, 2)), fg_shapes], axis=1),
+                "classes": np.concatenate([placements["bg_classes"], np.broadcast_to(np.asarray(fg_classes, dtype=int)[fg_slots], fg_scales.shape)], axis=1),
+                "indexes": np.concatenate([placements["bg_indexes"], placements["fg_indexes"][:, fg_slots]], axis=1),
+                "scales": np.concatenate([np.full((num_groups, num_bg), np.nan), fg_scales], axis=1),
+                "occlusions": np.concatenate([np.zeros((num_groups, num_bg, 3), dtype=int), placements["fg_occlusions"][:, fg_slots]], axis=1),
+                "labels": np.concatenate([np.zeros((num_groups, num_bg), dtype=int), np.broadcast_to(np.add(fg_slots, 1, dtype=int), fg_scales.shape)], axis=1)}
+    elements = {key: value.reshape(num_groups * value.shape[1], *value.shape[2:]) for key, value in elements.items()}
+    elements["boxes"] = np.concatenate([elements["coords"], elements.pop("coords") + elements.pop("shapes")], axis=1)
+    return elements
+
+
+def render_canvas_tile(elements, base_dataset, tile_box: tuple, fine_segment: bool, outputs: tuple=OUTPUTS,
+                       element_cache: dict=None):
+    """Renders a single tile of a canvas. Only the elements overlapping the tile are built, and pasted clipped to it.
+
+    :param elements: elements of the canvas, as given by `canvas_elements`.
+    :param tile_box: (top, left, bottom, right) box of the tile on the canvas.
+    :param fine_segment: If True, labelmaps are cut to the positive part of images.
+    :param outputs: arrays to render, among "image", "labelmap" and "bg_labelmap".
+    :param element_cache: (optional) dict keeping the transformed fg elements spanning several tiles, so that each is
+    rescaled and occluded once per canvas. Tiles must then be rendered in row-major order: elements are dropped from
+    the cache at their last tile (the one holding their bottom right corner).
+    :return: a dict of the tile arrays, as the arrays of `generate_image`.
+    """
+    tile_box = np.asarray(tile_box)
+    tile_shape = tuple(tile_box[2:] - tile_box[:2])
+    image = np.zeros(tile_shape, dtype="float32")
+    labelmap = np.zeros(tile_shape, dtype=LABELMAP_DTYPE) if "labelmap" in outputs else None
+    bg_labelmap = np.full(tile_shape, -1, dtype=BG_LABELMAP_DTYPE) if "bg_labelmap" in outputs else None
+
+    boxes = elements["boxes"]
+    overlapping = np.flatnonzero(np.all(boxes[:, :2] < tile_box[2:], axis=1) & np.all(boxes[:, 2:] > tile_box[:2], axis=1))
+    for e in overlapping:
+        cls, idx, label = elements["classes"][e], elements["indexes"][e], elements["labels"][e]
+        last_tile = np.all(boxes[e, 2:] <= tile_box[2:])
+        if label == 0:
+            element = base_dataset.get(cls, idx)
+        else:
+            element = element_cache.pop(e, None) if element_cache is not None else None
+            if element is None:
+                element = base_dataset.get_element(cls, idx, elements["scales"][e], elements["occlusions"][e])
+            if element_cache is not None and not last_tile:
+                element_cache[e] = element
+        # Clipping the element to the tile
+        top_left, bottom_right = np.maximum(boxes[e, :2], tile_box[:2]), np.minimum(boxes[e, 2:], tile_box[2:])
+        element_crop = element[top_left[0]-boxes[e, 0]:bottom_right[0]-boxes[e, 0], top_left[1]-boxes[e, 1]:bottom_right[1]-boxes[e, 1]]
+        tile_crop = np.s_[top_left[0]-tile_box[0]:bottom_right[0]-tile_box[0], top_left[1]-tile_box[1]:bottom_right[1]-tile_box[1]]
+
+        image[tile_crop] = element_crop
+        if label == 0:
+            if bg_labelmap is not None:
+                bg_labelmap[tile_crop] = (element_crop != 0) * cls if fine_segment else cls
+        elif labelmap is not None:
+            labelmap[tile_crop] = (element_crop != 0) * label if fine_segment else label
+
+    tile = {"image": image, "labelmap": labelmap, "bg_labelmap": bg_labelmap}
+    return {key: array for key, array in tile.items() if array is not None}
+
+
+def generate_canvas(seed, output_path: str, base_dataset, canvas_dimensions: tuple, group_dimensions: tuple,
+                    fg_classes: list, fg_positions: list, position_translation: float, position_noise: float,
+                    rescale_classes: list, rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple,
+                    bg_classes: list, bg_amount: float, bg_bbox: tuple, fine_segment: bool, omission_idxs: list=None,
+                    rescale_levels=None, outputs: tuple=OUTPUTS, rng_scheme: str="legacy", tile_size: int=TILE_SIZE,
+                    meta: dict=None):
+    """Generates a large CloStOb canvas tile by tile, writing each tile directly into memory-mapped .npy files, so that
+    memory use is bounded by the tile size rather than by the canvas size.
+
+    The files are written to a temporary folder, completed by a "meta.json" file, then moved to `output_path`: an
+    interrupted generation never leaves a canvas that `load_canvas` would open.
+
+    Each group cell of the canvas is identical to `generate_image` with the group seed (see `draw_canvas_placements`).
+
+    :param seed: Random number generator seed for this canvas.
+    :param output_path: folder to write the "image", "labelmap", "bg_labelmap" and "bboxes" .npy files to.
+    :param canvas_dimensions: dimensions of the canvas.
+    :param group_dimensions: dimensions of each structured-object group.
+    :param tile_size: side of the square tiles the canvas is rendered by.
+    :param meta: (optional) entries to add to the "meta.json" file (e.g. the configuration key, see `load_canvas`).
+    :return: a dict of the written arrays, opened read-only: memory-mapped "image" (H,W), "labelmap" (H,W) and
+    "bg_labelmap" (H,W), and "bboxes" (G,C,4) of every group's fg elements, normalised by the canvas dimensions. See
+    `generate_image` for the other parameters.
+    """
+    placements, _ = draw_canvas_placements(seed, base_dataset, canvas_dimensions, group_dimensions, fg_classes,
+                                           fg_positions, position_translation, position_noise, rescale_classes,
+                                           rescale_range, occlusion_classes, occlusion_range, bg_classes, bg_amount,
+                                           bg_bbox, rescale_levels=rescale_levels, rng_scheme=rng_scheme)
+    elements = canvas_elements(placements, base_dataset, fg_classes, omission_idxs)
+
+    temp_path = "{}.tmp{}".format(os.path.normpath(output_path), os.getpid())
+    os.makedirs(temp_path, exist_ok=True)
+    dtypes = {"image": np.float32, "labelmap": LABELMAP_DTYPE, "bg_labelmap": BG_LABELMAP_DTYPE}
+    canvases = {key: np.lib.format.open_memmap(os.path.join(temp_path, key + ".npy"), mode="w+", dtype=dtype,
+                                               shape=tuple(canvas_dimensions))
+                for key, dtype in dtypes.items() if key in outputs}
+    element_cache = {}  # Transformed elements spanning several tiles, until their last tile
+    for top in range(0, canvas_dimensions[0], tile_size):
+        for left in range(0, canvas_dimensions[1], tile_size):
+            tile_box = (top, left, min(top + tile_size, canvas_dimensions[0]), min(left + tile_size, canvas_dimensions[1]))
+            tile = render_canvas_tile(elements, base_dataset, tile_box, fine_segment, outputs, element_cache)
+            for key, canvas in canvases.items():
+                canvas[tile_box[0]:tile_box[2], tile_box[1]:tile_box[3]] = tile[key]
+    for canvas in canvases.values():
+        canvas.flush()
+    del canvases
+
+    if "bboxes" in outputs:
+        # Boxes of the fg elements, as in `generate_image`: (center, shape), normalised by the canvas dimensions
+        num_groups, num_fg = placements["fg_indexes"].shape
+        fg_boxes = canvas_elements(placements, base_dataset, fg_classes)["boxes"].reshape(num_groups, -1, 4)[:, -num_fg:]
+        fg_shapes = fg_boxes[..., 2:] - fg_boxes[..., :2]
+        bboxes = np.divide(np.concatenate([fg_boxes[..., :2] + np.floor_divide(fg_shapes, 2), fg_shapes], axis=-1),
+                           [*canvas_dimensions, *canvas_dimensions])
+        if omission_idxs:
+            bboxes[:, np.asarray(omission_idxs) - 1] = 0
+        np.save(os.path.join(temp_path, "bboxes.npy"), bboxes)
+    meta = dict(meta or {}, seed=seed, arrays=[key for key in OUTPUTS if key in outputs])
+    with open(os.path.join(temp_path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file, default=str)
+
+    # Moving the canvas in place, over any previous or incomplete one; if another process stored the same canvas (same
+    # key and seed) in the meantime, keeping theirs
+    stored_meta = read_canvas_meta(output_path)
+    if stored_meta is None or "key" not in meta or (stored_meta.get("key"), stored_meta["seed"]) != (meta["key"], seed):
+        shutil.rmtree(output_path, ignore_errors=True)
+    try:
+        os.replace(temp_path, output_path)
+    except OSError:
+        shutil.rmtree(temp_path)
+    return load_canvas(output_path)
+
+
+def read_canvas_meta(output_path: str):
+    """Reads the "meta.json" file of a canvas written by `generate_canvas`, or returns None if it is incomplete."""
+    meta_path = os.path.join(output_path, "meta.json")
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as meta_file:
+        return json.load(meta_file)
+
+
+def load_canvas(output_path: str, key: str=None):
+    """Opens a canvas written by `generate_canvas`, as read-only memory-mapped arrays.
+
+    :param output_path: folder of the canvas.
+    :param key: (optional) configuration key the canvas must have been generated with, as stored in its "meta.json".
+    :return: a dict of the arrays, as given by `generate_canvas`, or None if there is no complete canvas of this key.
+    """
+    meta = read_canvas_meta(output_path)
+    if meta is None or (key is not None and meta.get("key") != key):
+        return None
+    return {name: np.load(os.path.join(output_path, name + ".npy"), mmap_mode="r") for name in meta["arrays"]}
+
+
+class CanvasCloStObDataset(Dataset):
+    def __init__(self, base_dataset_name: str, canvas_dimensions: tuple, group_dimensions: tuple, size: int,
+                 output_dir: str, fg_classes: list, fg_positions: list, bg_classes: list, bg_amount: float,
+                 bg_bboxes: tuple = None, position_translation: float = 0.0, position_noise: float = 0.0,
+                 rescale_classes: list = [], rescale_range: tuple = (1,1), occlusion_classes: list = [],
+                 occlusion_range: tuple = (0,0), fine_segment: bool = False, start_seed: int = 0, to_tensor: bool = False,
+                 rescale_levels = None, outputs: tuple = None, rng_scheme: str = "legacy", tile_size: int = TILE_SIZE):
+        """Dataset of large CloStOb canvases, each generated tile by tile into `output_dir` on first access (see
+        `generate_canvas`) and memory-mapped from there on.
+
+        :param canvas_dimensions: dimensions of the canvases.
+        :param group_dimensions: dimensions of each structured-object group; group parameters (fg_positions, bg_bboxes,
+        ...) are relative to a group cell, as for a `CloStObDataset` of `image_dimensions=group_dimensions`.
+        :param size: number of canvases.
+        :param output_dir: folder to write the canvases to, in a sub-folder named after a hash of the generation
+        configuration (so that changing any parameter, or the base dataset files, never reuses stale canvases), with
+        one folder per seed.
+        :param to_tensor: If True, samples are emitted as tensors, normalized as by `batch_to_tensors`. Else, samples are
+        read-only memory-mapped arrays. Default: False.
+        :param tile_size: side of the square tiles canvases are rendered by. Default: `TILE_SIZE`.
+
+        See `CloStObDataset` for the other parameters. Rescale levels must be a list of scales.
+        """
+        assert outputs is None or set(outputs) <= set(OUTPUTS), "outputs must be among {}".format(OUTPUTS)
+        assert len(fg_classes) == len(fg_positions), "Length of fg_classes ({}) and fg_positions ({}) mismatch".format(
+            len(fg_classes), len(fg_positions))
+        self.base_dataset = load_dataset(base_dataset_name)
+        self.canvas_dimensions = canvas_dimensions
+        self.group_dimensions = group_dimensions
+        self.size = size
+        self.output_dir = output_dir
+        self.number_of_classes = 1 + len(fg_classes)
+        bg_bboxes = (0,0,*group_dimensions) if bg_bboxes is None else bg_bboxes
+        self.generation_args = (self.base_dataset, canvas_dimensions, group_dimensions, fg_classes, fg_positions,
+                                position_translation, position_noise, rescale_classes, rescale_range, occlusion_classes,
+                                occlusion_range, bg_classes, bg_amount, bg_bboxes, fine_segment)
+        self.start_seed = start_seed
+        self.to_tensor = to_tensor
+        self.rescale_levels = None if rescale_levels is None else np.asarray(rescale_levels, dtype=float)
+        if self.rescale_levels is not None:
+            self.base_dataset.build_pyramid(rescale_classes, self.rescale_levels)
+        self.outputs = OUTPUTS if outputs is None else tuple(key for key in OUTPUTS if key == "image" or key in outputs)
+        self.rng_scheme = rng_scheme
+        self.tile_size = tile_size
+        # Every parameter determining the canvases (but not the tile size, which leaves them unchanged)
+        self.config = {"base_dataset": base_dataset_fingerprint(base_dataset_name), "canvas_dimensions": list(canvas_dimensions),
+                       "group_dimensions": list(group_dimensions), "fg_classes": list(fg_classes),
+                       "fg_positions": np.asarray(fg_positions).tolist(), "position_translation": position_translation,
+                       "position_noise": position_noise, "rescale_classes": list(rescale_classes),
+                       "rescale_range": list(rescale_range), "occlusion_classes": list(occlusion_classes),
+                       "occlusion_range": list(occlusion_range), "bg_classes": list(bg_classes), "bg_amount": bg_amount,
+                       "bg_bboxes": list(bg_bboxes), "fine_segment": fine_segment,
+                       "rescale_levels": None if self.rescale_levels is None else self.rescale_levels.tolist(),
+                       "outputs": list(self.outputs), "rng_scheme": rng_scheme, "cache_version": CACHE_VERSION}
+        self.config_key = hashlib.sha256(json.dumps(self.config, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_canvas(self, idx):
+        """Gets the memory-mapped arrays of a canvas, generating it first if it is not in `output_dir` yet."""
+        seed = idx + self.start_seed
+        canvas_path = os.path.join(self.output_dir, self.config_key, str(seed))
+        canvas = load_canvas(canvas_path, self.config_key)
+        if canvas is not None:
+            return canvas
+        return generate_canvas(seed, canvas_path, *self.generation_args, rescale_levels=self.rescale_levels,
+                               outputs=self.outputs, rng_scheme=self.rng_scheme, tile_size=self.tile_size,
+                               meta={"key": self.config_key, "config": self.config})
+
+    def __getitem__(self, idx):
+        canvas = self.get_canvas(idx)
+        if self.to_tensor:
+            return {key: value[0] for key, value in batch_to_tensors({key: np.array(value)[None] for key, value in canvas.items()}).items()}
+        return canvas
+
+    def __len__(self):
+        return self.size
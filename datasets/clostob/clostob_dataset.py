@@ -7,43 +7,516 @@ Authors
  * Mateus Riva (mateus.riva@telecom-paris.fr)"""
 #%%
 import os
+import json
+import shutil
+import socket
+import hashlib
+import itertools
+import warnings
+import multiprocessing
+from functools import lru_cache
 import numpy as np
 import sys
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, default_collate, get_worker_info
 from skimage.transform import rescale
 
+# Number of samples generated at once when preloading a dataset
+PRELOAD_BATCH_SIZE = 256
+# Compact dtypes of the labelmaps (foreground classes up to 255) and background labelmaps (-1, then classes up to 127)
+LABELMAP_DTYPE = np.uint8
+BG_LABELMAP_DTYPE = np.int8
+# Version of the on-disk cache format; bumping it invalidates every existing cache entry
+CACHE_VERSION = 2
+
+def get_base_dataset_path(base_dataset_name):
+    """Gets the folder of one of the prepared base datasets for CloStOb."""
+    return os.path.join(os.path.dirname(__file__), base_dataset_name)
+
+# Arrays generated for each sample; "image" is always generated, the others can be left out
+OUTPUTS = ("image", "labelmap", "bboxes", "bg_labelmap")
+# Random number generation schemes, mapping seeds to samples: "legacy" seeds one PCG64 generator per sample, and
+# "philox-v1" reads the draws of each sample at a fixed place of a single counter-based Philox stream
+RNG_SCHEMES = ("legacy", "philox-v1")
+# Fixed key of the "philox-v1" stream; changing it changes every sample of the scheme
+PHILOX_KEY = 0x5A7A77
+# Compositors rendering batches of placements: numpy arrays (`render_batch`) or torch tensors (`render_batch_torch`)
+BACKENDS = ("numpy", "torch")
+# Numpy types of the IDX format's data type codes
+IDX_DTYPES = {0x08: ">u1", 0x09: ">i1", 0x0B: ">i2", 0x0C: ">i4", 0x0D: ">f4", 0x0E: ">f8"}
+
+def base_dataset_fingerprint(base_dataset_name):
+    """Fingerprints the files of a base dataset (names, sizes and modification times), so that changing them
+    invalidates anything cached from them."""
+    base_filepath = get_base_dataset_path(base_dataset_name)
+    return [(name, os.path.getsize(os.path.join(base_filepath, name)), os.path.getmtime(os.path.join(base_filepath, name)))
+            for name in sorted(os.listdir(base_filepath))]
+
+
+def read_idx(filepath):
+    """Memory-maps an IDX-format file (as used by MNIST-like datasets) without reading it.
+
+    :param filepath: path to the IDX file.
+    :return: a read-only `np.memmap` of the file's data, shaped as declared in its header.
+    """
+    with open(filepath, "rb") as idx_file:
+        magic = idx_file.read(4)
+        shape = tuple(int(dim) for dim in np.frombuffer(idx_file.read(4 * magic[3]), dtype=">i4"))
+    return np.memmap(filepath, dtype=IDX_DTYPES[magic[2]], mode="r", offset=4 + 4 * magic[3], shape=shape)
+
+
+def tensor_view(array):
+    """Views an array (possibly read-only, e.g. memory-mapped) as a tensor without copying it, for reading only."""
+    array = np.asarray(array)
+    if not array.dtype.isnative:
+        array = array.astype(array.dtype.newbyteorder("="))
+    with warnings.catch_warnings():  # Torch warns about read-only arrays, which are never written through the view
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(array)
+
+
+class ArrayStore:
+    def __init__(self, specs: dict, shared: bool = False):
+        """A single contiguous buffer holding several named arrays.
+
+        :param specs: dict of (shape, torch dtype) tuples, one for each named array.
+        :param shared: If True, the buffer is placed in shared memory. Pickling the store (e.g. for sending it to spawned
+        DataLoader workers) then only passes a handle to the buffer, and workers attach to it instead of copying it.
+        """
+        self.layout = {}
+        buffer_size = 0
+        for name, (shape, dtype) in specs.items():
+            nbytes = int(np.prod(shape)) * torch.tensor([], dtype=dtype).element_size()
+            self.layout[name] = (buffer_size, nbytes, tuple(shape), dtype)
+            buffer_size += -(-nbytes // 64) * 64  # Aligning every array to 64 bytes
+        self.buffer = torch.empty(buffer_size, dtype=torch.uint8)
+        if shared:
+            self.buffer.share_memory_()
+        self.tensors = self.get_views()
+
+    def get_views(self):
+        """Gets typed tensor views of each array of the buffer."""
+        return {name: self.buffer[offset:offset + nbytes].view(dtype).view(shape)
+                for name, (offset, nbytes, shape, dtype) in self.layout.items()}
+
+    def __getitem__(self, name):
+        return self.tensors[name]
+
+    def __getstate__(self):
+        return {"buffer": self.buffer, "layout": self.layout}
+
+    def __setstate__(self, state):
+        self.buffer, self.layout = state["buffer"], state["layout"]
+        self.tensors = self.get_views()
+
+
+class SampleStore:
+    def __init__(self, size: int, example_sample: dict, shared: bool = False):
+        """Contiguous storage of preloaded samples, with one stacked array per sample key.
+
+        Samples are returned as views into the storage, keeping the types (numpy array or tensor) of `example_sample`;
+        they must be treated as read-only. Batches are returned as stacked tensors: views for contiguous slices, or a
+        single `index_select` per key otherwise.
+
+        :param size: number of samples to store.
+        :param example_sample: a sample, for getting the shapes and types of each key.
+        :param shared: If True, the storage is placed in shared memory (see `ArrayStore`).
+        """
+        self.size = size
+        self.numpy_keys = [key for key, value in example_sample.items() if isinstance(value, np.ndarray)]
+        self.arrays = ArrayStore({key: ((size, *np.shape(value)), torch.as_tensor(value).dtype) for key, value in example_sample.items()}, shared)
+
+    def write(self, start: int, batch: dict):
+        """Writes a batch of consecutive samples, given as a dict of stacked tensors, starting at index `start`."""
+        for key, array in self.arrays.tensors.items():
+            array[start:start + len(batch[key])].copy_(batch[key])
+
+    def get_batch(self, idxs):
+        """Gets a batch of samples as a dict of stacked tensors.
+
+        :param idxs: a slice (returning views) or a list of indexes (returning `index_select` copies).
+        """
+        if isinstance(idxs, slice):
+            return {key: array[idxs] for key, array in self.arrays.tensors.items()}
+        idxs = torch.as_tensor(idxs, dtype=torch.long)
+        return {key: array.index_select(0, idxs) for key, array in self.arrays.tensors.items()}
+
+    def __getitem__(self, idx):
+        return {key: array[idx].numpy() if key in self.numpy_keys else array[idx] for key, array in self.arrays.tensors.items()}
+
+    def __len__(self):
+        return self.size
+
+
+class BaseDataset:
+    def __init__(self, images, labels):
+        """Class-indexed base dataset for CloStOb.
+
+        All images stay in a single contiguous (possibly memory-mapped) array, in their original order. A stable
+        argsort of the labels gives, for each class, the contiguous run of global indexes of its images, so that
+        picking the i-th image of a class is an O(1) lookup. The nonzero masks of the images are computed once, and
+        kept bit-packed along their rows next to the images, for cutting fine_segment labelmaps.
+
+        :param images: array of all base images, shaped (N,H,W).
+        :param labels: array of the N image labels.
+        """
+        self.images = images
+        self.labels = labels
+        self.image_shape = images.shape[1:]
+        self.masks = np.packbits(images != 0, axis=-1)
+        # Global indexes of the images, sorted by class (stable, so that each class keeps the original order)
+        self.class_order = np.argsort(labels, kind="stable")
+        # Start and count of each class' run in class_order, indexed by label
+        self.classes = np.unique(labels)
+        self.class_counts = np.bincount(labels, minlength=self.classes.max() + 1)
+        self.class_starts = np.concatenate([[0], np.cumsum(self.class_counts)[:-1]])
+        # Shared-memory storage of the arrays, if shared
+        self.store = None
+        # Rescaled images of some classes, as {(class, scale): array}, along with their on-disk files if cached
+        self.pyramid = {}
+        self.pyramid_files = {}
+
+    def share_memory(self):
+        """Moves the images and the class index to shared memory (see `ArrayStore`), exposed as read-only arrays.
+
+        :return: the base dataset itself.
+        """
+        if self.store is not None: return self
+        arrays = {"images": np.asarray(self.images, dtype=self.images.dtype.newbyteorder("=")),
+                  "masks": self.masks, "labels": self.labels, "class_order": self.class_order}
+        self.store = ArrayStore({name: (array.shape, torch.from_numpy(np.empty(0, dtype=array.dtype)).dtype) for name, array in arrays.items()}, shared=True)
+        for name, array in arrays.items():
+            self.store[name].numpy()[...] = array
+        self.attach_store()
+        return self
+
+    def attach_store(self):
+        """Points the arrays to read-only views of the shared-memory storage."""
+        for name in ["images", "masks", "labels", "class_order"]:
+            array = self.store[name].numpy()
+            array.flags.writeable = False
+            setattr(self, name, array)
+
+    def build_pyramid(self, classes, scales, cache_path: str = None):
+        """Precomputes the rescaled images of some classes at a set of scales, for `get_scaled` to look up.
+
+        :param classes: classes whose images to rescale.
+        :param scales: scales to rescale the images by.
+        :param cache_path: (optional) folder to cache the rescaled images in (as memory-mapped .npy files). It must be
+        specific to this base dataset.
+        """
+        for cls in classes:
+            for scale in scales:
+                if (cls, scale) in self.pyramid: continue
+                filepath = os.path.join(cache_path, "{}_{!r}.npy".format(cls, float(scale))) if cache_path is not None else None
+                if filepath is not None and os.path.exists(filepath):
+                    self.pyramid[cls, scale] = np.load(filepath, mmap_mode="r")
+                    self.pyramid_files[cls, scale] = filepath
+                    continue
+
+                level = np.stack([rescale(image, scale=scale, preserve_range=True) for image in self[cls]]).astype("float32")
+                if filepath is not None:
+                    # Saving to a temporary file first, so that concurrent builds never see a partial file
+                    os.makedirs(cache_path, exist_ok=True)
+                    temporary_filepath = "{}.{}.tmp.npy".format(filepath[:-4], os.getpid())
+                    np.save(temporary_filepath, level)
+                    os.replace(temporary_filepath, filepath)
+                    level = np.load(filepath, mmap_mode="r")
+                    self.pyramid_files[cls, scale] = filepath
+                self.pyramid[cls, scale] = level
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.store is not None:  # Only passing the shared storage handle
+            for name in ["images", "masks", "labels", "class_order"]:
+                del state[name]
+        # Cached pyramid levels are memory-mapped again from their files
+        state["pyramid"] = {key: level for key, level in self.pyramid.items() if key not in self.pyramid_files}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.store is not None:
+            self.attach_store()
+        for key, filepath in self.pyramid_files.items():
+            self.pyramid[key] = np.load(filepath, mmap_mode="r")
+
+    def count(self, cls):
+        """Number of images of a class."""
+        return int(self.class_counts[cls])
+
+    def global_indexes(self, classes, idxs):
+        """Converts (class, index within class) pairs, given as broadcastable arrays, to global image indexes."""
+        return self.class_order[self.class_starts[classes] + idxs]
+
+    def get(self, classes, idxs):
+        """Gathers (copies of) the images of the given (class, index within class) pairs."""
+        return np.take(self.images, self.global_indexes(classes, idxs), axis=0)
+
+    def get_masks(self, classes, idxs):
+        """Gathers (copies of) the nonzero masks of the images of the given (class, index within class) pairs."""
+        masks = np.take(self.masks, self.global_indexes(classes, idxs), axis=0)
+        return np.unpackbits(masks, axis=-1, count=self.image_shape[-1]).view(bool)
+
+    def get_scaled(self, cls, idxs, scale):
+        """Gathers (copies of) the images of a class rescaled by `scale`, which must be NaN (not rescaled) or one of its
+        pyramid scales (see `build_pyramid`)."""
+        if np.isnan(scale):
+            return self.get(cls, idxs)
+        return np.take(self.pyramid[cls, scale], idxs, axis=0)
+
+    def get_scaled_tensor(self, cls, idxs, scale):
+        """Gathers the images of a class rescaled by `scale` as a tensor, with a single `index_select` (see
+        `get_scaled`)."""
+        if np.isnan(scale):
+            return tensor_view(self.images).index_select(0, torch.as_tensor(self.global_indexes(cls, idxs), dtype=torch.long))
+        return tensor_view(self.pyramid[cls, scale]).index_select(0, torch.as_tensor(idxs, dtype=torch.long))
+
+    def get_element(self, cls, idx, scale, occlusion):
+        """Gets a transformed fg element (see `transform_element`), looking it up in the pyramid if it holds it."""
+        if (cls, scale) in self.pyramid:
+            return transform_element(self.get_scaled(cls, idx, scale), np.nan, occlusion)
+        return transform_element(self.get(cls, idx), scale, occlusion)
+
+    def get_element_mask(self, cls, idx, scale, occlusion, element):
+        """Gets the nonzero mask of a transformed fg element, as given by `get_element`. The precomputed mask is used
+        for elements which are not rescaled."""
+        if np.isnan(scale):
+            return transform_element(self.get_masks(cls, idx), scale, occlusion)
+        return element != 0
+
+    def __getitem__(self, cls):
+        """Gets (a copy of) all images of a class."""
+        return self.images[self.class_order[self.class_starts[cls]:self.class_starts[cls] + self.class_counts[cls]]]
+
+    def __len__(self):
+        return len(self.images)
+
+
+@lru_cache(maxsize=None)
 def load_dataset(base_dataset_name):
     """Loads one of the prepared base datasets for CloStOb.
 
-    NOTE: this currently only supports Fashion-MNIST (as "fashion").
+    The base dataset folder must contain an "images" and a "labels" IDX-format file (e.g. Fashion-MNIST, as
+    "fashion"). Files are memory-mapped rather than read, and loaded datasets are memoized per process, so that every
+    CloStObDataset instance shares the same base dataset.
 
     :param base_dataset_name: name of the base dataset folder
-    :return: a dict of image lists, keyed by classes
+    :return: the class-indexed `BaseDataset`
     """
-    if os.path.split(base_dataset_name)[1] != "fashion": raise NotImplementedError("Only 'fashion' dataset has been implemented")
+    base_filepath = get_base_dataset_path(base_dataset_name)
 
-    base_filepath = os.path.join(os.path.dirname(__file__), base_dataset_name)
+    labels = read_idx(os.path.join(base_filepath, "labels"))
+    images = read_idx(os.path.join(base_filepath, "images"))
+    if len(images) != len(labels):
+        raise ValueError("Base dataset '{}' has {} images but {} labels".format(base_dataset_name, len(images), len(labels)))
 
-    with open(os.path.join(base_filepath, "labels"), "rb") as labels_file:
-        labels = np.frombuffer(labels_file.read(), dtype=np.uint8, offset=8)
+    # Plain array views of the memory maps, so that gathered images are plain arrays
+    return BaseDataset(np.asarray(images), np.asarray(labels, dtype=int))
 
-    with open(os.path.join(base_filepath, "images"), "rb") as images_file:
-        images = np.frombuffer(images_file.read(), dtype=np.uint8, offset=16).reshape(len(labels), 28, 28)
 
-    base_dataset = {}
-    for image, label in zip(images, labels):
-        if label not in base_dataset:
-            base_dataset[label] = [image]
-        else:
-            base_dataset[label].append(image)
-    return base_dataset
+def draw_placements(seed, base_dataset, image_dimensions: tuple, fg_classes: list, fg_positions: list,
+                    position_translation: float, position_noise: float, rescale_classes: list,
+                    rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple,
+                    bg_classes: list, bg_amount: float, bg_bbox: tuple, rescale_levels=None, rng_scheme: str="legacy"):
+    """Draws the random placement parameters of a single CloStOb image, without building any pixels.
+
+    The draws are consumed from `np.random.default_rng(seed)` in exactly the same order as the original per-element
+    generation loop, so that rendering these placements reproduces the seed => image mapping bit for bit.
+
+    :param seed: Random number generator seed for this image.
+    :param base_dataset: loaded base dataset.
+    :param rescale_levels: (optional) array of scales to snap the drawn scales to (see `BaseDataset.build_pyramid`).
+    :param rng_scheme: one of `RNG_SCHEMES`; "philox-v1" draws the placements with `draw_placements_philox` instead.
+    :return: a dict containing, for the background elements, their "bg_classes", "bg_indexes" (within their class)
+    and top-left "bg_coords"; and for the foreground elements, their "fg_indexes" (within their class), top-left
+    "fg_coords", "fg_scales" (NaN when not rescaled) and "fg_occlusions" as (size, x, y) squares (size 0 when not
+    occluded).
+    """
+    if rng_scheme != "legacy":
+        placements = draw_batch_placements([seed], base_dataset, image_dimensions, fg_classes, fg_positions,
+                                           position_translation, position_noise, rescale_classes, rescale_range,
+                                           occlusion_classes, occlusion_range, bg_classes, bg_amount, bg_bbox,
+                                           rescale_levels=rescale_levels, rng_scheme=rng_scheme)
+        return {key: value[0] for key, value in placements.items()}
+
+    # Initialising RNG with specified seed
+    rng = np.random.default_rng(seed)
+
+    # Getting shape of base dataset images
+    base_shape = base_dataset.image_shape
+    # Initialising limits on coordinates to avoid images "leaking out the border"
+    coordinates_limit = tuple(np.array(image_dimensions) - base_shape)
+    # Binding the coordinate limits to the bg_bbox
+    bg_coordinates_limit = (max(0, bg_bbox[0]*image_dimensions[0]), max(0, bg_bbox[1]*image_dimensions[1]),
+                            min(coordinates_limit[0], bg_bbox[2]*image_dimensions[0]), min(coordinates_limit[1], bg_bbox[3]*image_dimensions[1]))
+
+    # Choosing background elements (drawing an index is equivalent to `rng.choice` over the class images)
+    bg_chosen_classes = rng.choice(bg_classes, bg_amount, replace=True)
+    bg_indexes = np.array([rng.choice(base_dataset.count(bg_class)) for bg_class in bg_chosen_classes], dtype=int)
+    # Choosing random background coordinates
+    bg_coords = np.array([rng.integers(low=bg_coordinates_limit[:2], high=bg_coordinates_limit[2:], size=len(image_dimensions))
+                          for _ in bg_chosen_classes], dtype=int).reshape(len(bg_chosen_classes), len(image_dimensions))
+
+    # Preparing fg coordinates
+    fg_positions = np.array(fg_positions)
+    # Global translation
+    fg_positions += rng.uniform(low=-position_translation / 2, high=position_translation / 2,
+                                size=fg_positions.shape[1:])
+    # Individual translations (structural noise)
+    fg_positions += rng.uniform(low=-position_noise / 2, high=position_noise / 2, size=fg_positions.shape)
+    # Converting to real pixel coordinates
+    fg_origin_coords_set = (fg_positions * image_dimensions - np.array(base_shape) // 2).astype(int)
+    fg_origin_coords_set[fg_origin_coords_set<0] = 0  # Guaranteeing no underflow
+    fg_origin_coords_set[:,0][fg_origin_coords_set[:,0]>coordinates_limit[0]] = coordinates_limit[0]  # Guaranteeing no overflow
+    fg_origin_coords_set[:,1][fg_origin_coords_set[:,1]>coordinates_limit[1]] = coordinates_limit[1]  # Guaranteeing no overflow
+
+    # Choosing fg elements and their transformations
+    fg_indexes = np.zeros(len(fg_classes), dtype=int)
+    fg_scales = np.full(len(fg_classes), np.nan)
+    fg_occlusions = np.zeros((len(fg_classes), 3), dtype=int)
+    for idx, fg_class in enumerate(fg_classes):
+        fg_indexes[idx] = rng.choice(base_dataset.count(fg_class))
+        element_shape = np.array(base_shape)
+
+        # Drawing the scale; the rescaled shape follows `skimage.transform.rescale`
+        if fg_class in rescale_classes:
+            fg_scales[idx] = rng.uniform(low=rescale_range[0], high=rescale_range[1])
+            # Snapping the scale to the nearest level, if quantized
+            if rescale_levels is not None:
+                fg_scales[idx] = rescale_levels[np.argmin(np.abs(rescale_levels - fg_scales[idx]))]
+            element_shape = np.maximum(np.round(fg_scales[idx] * element_shape), 1).astype(int)
+
+        # Drawing the occlusion square
+        if fg_class in occlusion_classes:
+            occlusion_size = rng.integers(low=occlusion_range[0], high=occlusion_range[1])
+            occlusion_point_x = rng.integers(low=0, high=element_shape[0]-occlusion_size)
+            occlusion_point_y = rng.integers(low=0, high=element_shape[1]-occlusion_size)
+            fg_occlusions[idx] = (occlusion_size, occlusion_point_x, occlusion_point_y)
+
+    return {"bg_classes": bg_chosen_classes, "bg_indexes": bg_indexes, "bg_coords": bg_coords,
+            "fg_indexes": fg_indexes, "fg_coords": fg_origin_coords_set, "fg_scales": fg_scales,
+            "fg_occlusions": fg_occlusions}
+
+
+def draw_placements_philox(seeds, base_dataset, image_dimensions: tuple, fg_classes: list, fg_positions: list,
+                           position_translation: float, position_noise: float, rescale_classes: list,
+                           rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple,
+                           bg_classes: list, bg_amount: float, bg_bbox: tuple, rescale_levels=None):
+    """Draws the random placement parameters of a batch of CloStOb images at once, with the "philox-v1" scheme.
+
+    Every sample owns a fixed number of uniform draws, laid out the same way whatever its classes (4 per bg element:
+    class, index and coordinates; 2 for the global translation; 7 per fg element: noise, index, scale and occlusion
+    size and point), padded to whole Philox blocks of 4 draws. The draws of seed `s` are then blocks
+    [s*B, (s+1)*B) of the Philox stream keyed by `PHILOX_KEY`: any sample can be drawn on its own, and any contiguous
+    run of seeds is drawn in a single call, giving the very same samples either way. This layout is frozen for
+    "philox-v1"; changing it requires a new scheme version.
+
+    :param seeds: list of non-negative random number generator seeds, one per image.
+    :return: a dict of the `draw_placements` arrays, stacked along a first batch axis. See `draw_placements` for the
+    other parameters.
+    """
+    seeds = np.asarray(seeds, dtype=np.int64)
+    batch_size, num_fg, num_bg = len(seeds), len(fg_classes), int(bg_amount)
+    base_shape = np.array(base_dataset.image_shape)
+
+    # Drawing the uniform draws of each sample, in a single call per contiguous run of seeds
+    num_draws = 4*num_bg + 2 + 7*num_fg
+    num_blocks = -(-num_draws // 4)
+    draws = np.empty((batch_size, 4*num_blocks))
+    run_starts = np.flatnonzero(np.diff(seeds, prepend=seeds[:1] - 2) != 1)
+    for start, stop in zip(run_starts, [*run_starts[1:], batch_size]):
+        generator = np.random.Generator(np.random.Philox(key=PHILOX_KEY, counter=int(seeds[start]) * num_blocks))
+        draws[start:stop] = generator.random((stop - start, 4*num_blocks))
+    bg_draws, translation_draws, fg_draws = np.split(draws[:, :num_draws], [4*num_bg, 4*num_bg + 2], axis=1)
+    bg_draws, fg_draws = bg_draws.reshape(batch_size, num_bg, 4), fg_draws.reshape(batch_size, num_fg, 7)
+
+    # Initialising limits on coordinates to avoid images "leaking out the border"
+    coordinates_limit = np.array(image_dimensions) - base_shape
+    # Binding the coordinate limits to the bg_bbox
+    bg_low = np.array([max(0, bg_bbox[0]*image_dimensions[0]), max(0, bg_bbox[1]*image_dimensions[1])]).astype(int)
+    bg_high = np.array([min(coordinates_limit[0], bg_bbox[2]*image_dimensions[0]), min(coordinates_limit[1], bg_bbox[3]*image_dimensions[1])]).astype(int)
+
+    # Choosing background elements and their coordinates
+    bg_chosen_classes = np.asarray(bg_classes)[(bg_draws[..., 0] * len(bg_classes)).astype(int)]
+    bg_indexes = (bg_draws[..., 1] * base_dataset.class_counts[bg_chosen_classes]).astype(int)
+    bg_coords = bg_low + (bg_draws[..., 2:] * (bg_high - bg_low)).astype(int)
+
+    # Preparing fg coordinates, with the global translation and the individual translations (structural noise)
+    fg_positions = np.broadcast_to(np.array(fg_positions, dtype=float), (batch_size, num_fg, 2))
+    fg_positions = fg_positions + (translation_draws[:, None, :] - 0.5) * position_translation
+    fg_positions = fg_positions + (fg_draws[..., 0:2] - 0.5) * position_noise
+    # Converting to real pixel coordinates
+    fg_coords = np.clip((fg_positions * image_dimensions - base_shape // 2).astype(int), 0, coordinates_limit)
+
+    # Choosing fg elements and their transformations
+    fg_counts = base_dataset.class_counts[np.asarray(fg_classes, dtype=int)]
+    fg_indexes = (fg_draws[..., 2] * fg_counts).astype(int)
+    rescaled = np.isin(fg_classes, rescale_classes)
+    fg_scales = np.where(rescaled, rescale_range[0] + fg_draws[..., 3] * (rescale_range[1] - rescale_range[0]), np.nan)
+    # Snapping the scales to the nearest level, if quantized
+    if rescale_levels is not None:
+        fg_scales = np.where(rescaled, rescale_levels[np.argmin(np.abs(fg_scales[..., None] - rescale_levels), axis=-1)], np.nan)
+    # The rescaled shape follows `skimage.transform.rescale`
+    element_shapes = np.where(rescaled[:, None], np.maximum(np.round(np.nan_to_num(fg_scales, nan=1)[..., None] * base_shape), 1), base_shape).astype(int)
+    occluded = np.isin(fg_classes, occlusion_classes)
+    occlusion_sizes = occlusion_range[0] + (fg_draws[..., 4] * (occlusion_range[1] - occlusion_range[0])).astype(int)
+    occlusion_points = (fg_draws[..., 5:7] * (element_shapes - occlusion_sizes[..., None])).astype(int)
+    fg_occlusions = np.where(occluded[:, None], np.concatenate([occlusion_sizes[..., None], occlusion_points], axis=-1), 0)
+
+    return {"bg_classes": bg_chosen_classes, "bg_indexes": bg_indexes, "bg_coords": bg_coords,
+            "fg_indexes": fg_indexes, "fg_coords": fg_coords, "fg_scales": fg_scales, "fg_occlusions": fg_occlusions}
+
+
+def draw_batch_placements(seeds, base_dataset, image_dimensions: tuple, fg_classes: list, fg_positions: list,
+                          position_translation: float, position_noise: float, rescale_classes: list,
+                          rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple,
+                          bg_classes: list, bg_amount: float, bg_bbox: tuple, rescale_levels=None, rng_scheme: str="legacy"):
+    """Draws the random placement parameters of a batch of CloStOb images, with the given RNG scheme.
+
+    :param seeds: list of random number generator seeds, one per image.
+    :param rng_scheme: one of `RNG_SCHEMES`. "legacy" draws seed by seed (see `draw_placements`), "philox-v1" draws
+    the whole batch at once (see `draw_placements_philox`).
+    :return: a dict of the `draw_placements` arrays, stacked along a first batch axis. See `draw_placements` for the
+    other parameters.
+    """
+    if rng_scheme == "philox-v1":
+        return draw_placements_philox(seeds, base_dataset, image_dimensions, fg_classes, fg_positions, position_translation,
+                                      position_noise, rescale_classes, rescale_range, occlusion_classes, occlusion_range,
+                                      bg_classes, bg_amount, bg_bbox, rescale_levels=rescale_levels)
+    if rng_scheme != "legacy":
+        raise ValueError("Unknown RNG scheme '{}', must be one of {}".format(rng_scheme, RNG_SCHEMES))
+    placements = [draw_placements(seed, base_dataset, image_dimensions, fg_classes, fg_positions, position_translation,
+                                  position_noise, rescale_classes, rescale_range, occlusion_classes, occlusion_range,
+                                  bg_classes, bg_amount, bg_bbox, rescale_levels=rescale_levels) for seed in seeds]
+    return {key: np.stack([placement[key] for placement in placements]) for key in placements[0]}
+
+
+def transform_element(element, scale, occlusion):
+    """Applies the drawn rescale and occlusion transformations to a single base element.
+
+    :param element: base element image.
+    :param scale: scale to rescale the element by, or NaN for no rescaling.
+    :param occlusion: (size, x, y) occlusion square to zero out of the element.
+    :return: a new, transformed element (the base element is never modified).
+    """
+    # Applying resizing
+    if not np.isnan(scale):
+        element = rescale(element, scale=scale, preserve_range=True)
+    else:
+        element = element.copy()
+
+    # Applying occlusion
+    occlusion_size, occlusion_point_x, occlusion_point_y = occlusion
+    element[occlusion_point_x:occlusion_point_x+occlusion_size, occlusion_point_y:occlusion_point_y+occlusion_size] = 0
+    return element
 
 
 def generate_image(seed, base_dataset, image_dimensions: tuple, fg_classes: list, fg_positions: list,
                    position_translation: float, position_noise: float, rescale_classes: list, 
                    rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple, 
                    bg_classes: list, bg_amount: float, bg_bbox: tuple, fine_segment: bool, flattened: bool,
-                   omission_idxs: list=None):
+                   omission_idxs: list=None, rescale_levels=None, outputs: tuple=OUTPUTS, rng_scheme: str="legacy"):
     """Generates a single CloStOb image and corresponding label map and bounding boxes.
 
     :param seed: Random number generator seed for this image.
@@ -64,75 +537,49 @@ def generate_image(seed, base_dataset, image_dimensions: tuple, fg_classes: list
     :param fine_segment: If True, labelmaps are cut to the positive part of images.
     :param flattened: If True, return images as flattened 1D arrays. Else, return images shaped like `size`.
     :param omission_idxs: If not None, fg_classes with indexes in omission_idxs will not be added to the image.
+    :param rescale_levels: If not None, array of scales the rescale scales are snapped to. Scales held in the base
+    dataset pyramid are then looked up rather than rescaled (see `BaseDataset.build_pyramid`).
+    :param outputs: arrays to generate, among `OUTPUTS`. "image" is always generated; the others are not built at all
+    if left out.
+    :param rng_scheme: random number generation scheme mapping seeds to images, among `RNG_SCHEMES`.
     :return: a tuple (image, labelmap) containing the image and corresponding labelmap.
     """
-    # Initialising RNG with specified seed
-    rng = np.random.default_rng(seed)
+    # Drawing all random placement parameters
+    placements = draw_placements(seed, base_dataset, image_dimensions, fg_classes, fg_positions, position_translation,
+                                 position_noise, rescale_classes, rescale_range, occlusion_classes, occlusion_range,
+                                 bg_classes, bg_amount, bg_bbox, rescale_levels=rescale_levels, rng_scheme=rng_scheme)
 
     # Casting a None omission_idxs to empty list
     if omission_idxs is None: omission_idxs = []
 
-    # Creating empty base image and labelmap
-    image, labelmap = np.zeros(image_dimensions, dtype="float32"), np.zeros(image_dimensions, dtype=int)
+    # Creating empty base image and labelmap (unrequested outputs are never built)
+    image = np.zeros(image_dimensions, dtype="float32")
+    labelmap = np.zeros(image_dimensions, dtype=LABELMAP_DTYPE) if "labelmap" in outputs else None
     # Creating empty bounding boxes list - one (x,y,w,h) tuple for each fg_class
-    bboxes = np.zeros((len(fg_classes), 4))
+    bboxes = np.zeros((len(fg_classes), 4)) if "bboxes" in outputs else None
     # Creating background labelmap
-    bg_labelmap = np.ones(image_dimensions, dtype=int)*-1
+    bg_labelmap = np.full(image_dimensions, -1, dtype=BG_LABELMAP_DTYPE) if "bg_labelmap" in outputs else None
     # Getting shape of base dataset images
-    base_shape = base_dataset[bg_classes[0]][0].shape
-    # Initialising limits on coordinates to avoid images "leaking out the border"
-    coordinates_limit = tuple(np.array(image_dimensions) - base_shape)
-    # Binding the coordinate limits to the bg_bbox
-    bg_coordinates_limit = (max(0, bg_bbox[0]*image_dimensions[0]), max(0, bg_bbox[1]*image_dimensions[1]),
-                            min(coordinates_limit[0], bg_bbox[2]*image_dimensions[0]), min(coordinates_limit[1], bg_bbox[3]*image_dimensions[1]))
+    base_shape = base_dataset.image_shape
 
-    # Preparing list of potential background elements
-    bg_chosen_classes = rng.choice(bg_classes, bg_amount, replace=True)
-    bg_elements = [(rng.choice(base_dataset[bg_class]), bg_class) for bg_class in bg_chosen_classes]
     # Distributing background images
-    for idx, bg_element in enumerate(bg_elements):
-        # Choosing random coordinates
-        bg_origin_coords = rng.integers(low=bg_coordinates_limit[:2], high=bg_coordinates_limit[2:], size=len(image_dimensions))
+    for bg_class, bg_index, bg_origin_coords in zip(placements["bg_classes"], placements["bg_indexes"], placements["bg_coords"]):
+        bg_element = base_dataset.get(bg_class, bg_index)
         bg_element_coords = tuple(
             np.s_[origin:end] for origin, end in zip(bg_origin_coords, bg_origin_coords + base_shape))
         # Adding bg element
-        image[bg_element_coords] = bg_element[0]
+        image[bg_element_coords] = bg_element
         # Adding to background labelmap
-        bg_map_element = np.full(bg_element[0].shape, bg_element[1])
+        if bg_labelmap is None: continue
         if fine_segment:  # If the labelmap should cut out the zero part
-            bg_map_element[bg_element[0] == 0] = 0
-        bg_labelmap[bg_element_coords] = bg_map_element
-
-    # Preparing fg coordinates
-    fg_positions = np.array(fg_positions)
-    # Global translation
-    fg_positions += rng.uniform(low=-position_translation / 2, high=position_translation / 2,
-                                size=fg_positions.shape[1:])
-    # Individual translations (structural noise)
-    fg_positions += rng.uniform(low=-position_noise / 2, high=position_noise / 2, size=fg_positions.shape)
-    # Converting to real pixel coordinates
-    fg_origin_coords_set = (fg_positions * image_dimensions - np.array(base_shape) // 2).astype(int)
-    fg_origin_coords_set[fg_origin_coords_set<0] = 0  # Guaranteeing no underflow
-    fg_origin_coords_set[:,0][fg_origin_coords_set[:,0]>coordinates_limit[0]] = coordinates_limit[0]  # Guaranteeing no overflow
-    fg_origin_coords_set[:,1][fg_origin_coords_set[:,1]>coordinates_limit[1]] = coordinates_limit[1]  # Guaranteeing no overflow
+            bg_labelmap[bg_element_coords] = np.multiply(base_dataset.get_masks(bg_class, bg_index), bg_class, dtype=BG_LABELMAP_DTYPE)
+        else:
+            bg_labelmap[bg_element_coords] = bg_class
 
     # Distributing fg images
-    to_rescale = {fg_class : fg_class in rescale_classes for fg_class in fg_classes}
-    to_occlude = {fg_class : fg_class in occlusion_classes for fg_class in fg_classes}
-    for idx, pack in enumerate(zip(fg_classes, fg_origin_coords_set)):
-        fg_class, fg_origin_coords = pack
-        fg_element = rng.choice(base_dataset[fg_class])
-
-        # Applying resizing
-        if to_rescale[fg_class]:
-            fg_element = rescale(fg_element, scale=rng.uniform(low=rescale_range[0], high=rescale_range[1]), preserve_range=True)
-        
-        # Applying occlusion:
-        if to_occlude[fg_class]:
-            occlusion_size = rng.integers(low=occlusion_range[0], high=occlusion_range[1])
-            occlusion_point_x = rng.integers(low=0, high=fg_element.shape[0]-occlusion_size)
-            occlusion_point_y = rng.integers(low=0, high=fg_element.shape[1]-occlusion_size)
-            fg_element[occlusion_point_x:occlusion_point_x+occlusion_size, occlusion_point_y:occlusion_point_y+occlusion_size] = 0
+    for idx, pack in enumerate(zip(fg_classes, placements["fg_indexes"], placements["fg_coords"], placements["fg_scales"], placements["fg_occlusions"])):
+        fg_class, fg_index, fg_origin_coords, fg_scale, fg_occlusion = pack
+        fg_element = base_dataset.get_element(fg_class, fg_index, fg_scale, fg_occlusion)
 
         # If element is not omitted, add to image
         if not (idx+1) in omission_idxs:
@@ -141,18 +588,589 @@ def generate_image(seed, base_dataset, image_dimensions: tuple, fg_classes: list
             # Adding fg element
             image[fg_element_coords] = fg_element
             # Adding labelmap element        
-            map_element = np.full(fg_element.shape, idx+1)
-            if fine_segment:  # If the labelmap should cut out the zero part
-                map_element[fg_element == 0] = 0
-            labelmap[fg_element_coords] = map_element
+            if labelmap is not None:
+                if fine_segment:  # If the labelmap should cut out the zero part
+                    fg_mask = base_dataset.get_element_mask(fg_class, fg_index, fg_scale, fg_occlusion, fg_element)
+                    labelmap[fg_element_coords] = np.multiply(fg_mask, idx+1, dtype=LABELMAP_DTYPE)
+                else:
+                    labelmap[fg_element_coords] = idx+1
             # Adding bounding box element
-            bboxes[idx] = np.divide([*(fg_origin_coords + np.floor_divide(fg_element.shape,2)), *fg_element.shape], [*image_dimensions,*image_dimensions])
+            if bboxes is not None:
+                bboxes[idx] = np.divide([*(fg_origin_coords + np.floor_divide(fg_element.shape,2)), *fg_element.shape], [*image_dimensions,*image_dimensions])
 
     # Flattening image if necessary
     if flattened:
         image = image.flatten()
 
-    return {"image": image, "labelmap": labelmap, "bboxes": bboxes, "bg_labelmap": bg_labelmap}
+    sample = {"image": image, "labelmap": labelmap, "bboxes": bboxes, "bg_labelmap": bg_labelmap}
+    return {key: array for key, array in sample.items() if array is not None}
+
+
+def paste_batch(canvases, coords, patches, canvas_idxs=None):
+    """Pastes one patch into each canvas of a batch, as a single scatter.
+
+    :param canvases: batch of canvases, shaped (N,H,W).
+    :param coords: top-left coordinates of each patch, shaped (N,2) (or (M,2) if canvas_idxs is given).
+    :param patches: patches to paste, shaped (N,h,w) (or (M,h,w)) or broadcastable to it.
+    :param canvas_idxs: (optional) indexes of the M canvases to paste into, if not all of them.
+    """
+    if canvas_idxs is None: canvas_idxs = np.arange(len(coords))
+    patch_shape = np.shape(patches)[-2:]
+    rows = coords[:, 0, None, None] + np.arange(patch_shape[0])[None, :, None]
+    cols = coords[:, 1, None, None] + np.arange(patch_shape[1])[None, None, :]
+    canvases[canvas_idxs[:, None, None], rows, cols] = patches
+
+
+def generate_batch(seeds, base_dataset, image_dimensions: tuple, fg_classes: list, fg_positions: list,
+                   position_translation: float, position_noise: float, rescale_classes: list,
+                   rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple,
+                   bg_classes: list, bg_amount: float, bg_bbox: tuple, fine_segment: bool, flattened: bool,
+                   omission_idxs: list=None, rescale_levels=None, outputs: tuple=OUTPUTS, rng_scheme: str="legacy",
+                   backend: str="numpy"):
+    """Generates a batch of CloStOb images, label maps and bounding boxes at once.
+
+    The output is bit-identical to stacking `generate_image` for each seed. With the "legacy" RNG scheme each seed owns
+    its own RNG stream, so the (cheap) random draws are still taken seed by seed; with "philox-v1" they are taken for
+    the whole batch at once. All pixel work is then done for the whole batch at once, one scatter per element slot, so
+    that later elements overwrite earlier ones exactly as in `generate_image`.
+
+    :param seeds: non-empty list of random number generator seeds, one per image.
+    :param backend: compositor, among `BACKENDS`. "torch" renders the very same values as tensors (see
+    `render_batch_torch`).
+    :return: a dict of stacked "image" (N,H,W) (or (N,H*W) if flattened), "labelmap" (N,H,W), "bboxes" (N,C,4) and
+    "bg_labelmap" (N,H,W) arrays, for the requested outputs. See `generate_image` for the other parameters.
+    """
+    # Drawing all random placement parameters
+    placements = draw_batch_placements(seeds, base_dataset, image_dimensions, fg_classes, fg_positions, position_translation,
+                                       position_noise, rescale_classes, rescale_range, occlusion_classes, occlusion_range,
+                                       bg_classes, bg_amount, bg_bbox, rescale_levels=rescale_levels, rng_scheme=rng_scheme)
+    render_fn = render_batch_torch if backend == "torch" else render_batch
+    return render_fn(placements, base_dataset, image_dimensions, fg_classes, rescale_classes, fine_segment, flattened,
+                     omission_idxs=omission_idxs, outputs=outputs)
+
+
+def render_batch(placements, base_dataset, image_dimensions: tuple, fg_classes: list, rescale_classes: list,
+                 fine_segment: bool, flattened: bool, omission_idxs: list=None, outputs: tuple=OUTPUTS):
+    """Renders a batch of drawn placements into CloStOb images, label maps and bounding boxes.
+
+    :param placements: dict of the `draw_placements` arrays, stacked along a first batch axis.
+    :return: a dict of stacked arrays, as in `generate_batch`. See `generate_image` for the other parameters.
+    """
+    # Casting a None omission_idxs to empty list
+    if omission_idxs is None: omission_idxs = []
+
+    # Creating empty base images and labelmaps (unrequested outputs are never built)
+    batch_size = len(placements["fg_indexes"])
+    images = np.zeros((batch_size, *image_dimensions), dtype="float32")
+    labelmaps = np.zeros((batch_size, *image_dimensions), dtype=LABELMAP_DTYPE) if "labelmap" in outputs else None
+    # Creating empty bounding boxes - one (x,y,w,h) tuple for each fg_class
+    bboxes = np.zeros((batch_size, len(fg_classes), 4)) if "bboxes" in outputs else None
+    # Creating background labelmaps
+    bg_labelmaps = np.full((batch_size, *image_dimensions), -1, dtype=BG_LABELMAP_DTYPE) if "bg_labelmap" in outputs else None
+
+    # Distributing background images, one element slot at a time
+    for slot in range(placements["bg_classes"].shape[1]):
+        slot_classes = placements["bg_classes"][:, slot]
+        bg_elements = base_dataset.get(slot_classes, placements["bg_indexes"][:, slot])
+        paste_batch(images, placements["bg_coords"][:, slot], bg_elements)
+        if bg_labelmaps is None: continue
+        bg_map_elements = np.broadcast_to(slot_classes.astype(BG_LABELMAP_DTYPE)[:, None, None], bg_elements.shape)
+        if fine_segment:  # If the labelmap should cut out the zero part
+            bg_map_elements = base_dataset.get_masks(slot_classes, placements["bg_indexes"][:, slot]) * bg_map_elements
+        paste_batch(bg_labelmaps, placements["bg_coords"][:, slot], bg_map_elements)
+
+    # Distributing fg images, one element slot at a time
+    for idx, fg_class in enumerate(fg_classes):
+        fg_coords, fg_scales, fg_occlusions = placements["fg_coords"][:, idx], placements["fg_scales"][:, idx], placements["fg_occlusions"][:, idx]
+        # Omitted elements are drawn but never added to the images
+        if (idx+1) in omission_idxs: continue
+
+        if fg_class in rescale_classes and not all((fg_class, scale) in base_dataset.pyramid for scale in np.unique(fg_scales)):
+            # Rescaled elements have varying shapes: falling back to the per-element path
+            for n in range(batch_size):
+                fg_element = base_dataset.get_element(fg_class, placements["fg_indexes"][n, idx], fg_scales[n], fg_occlusions[n])
+                fg_element_coords = (n, *(np.s_[origin:end] for origin, end in zip(fg_coords[n], fg_coords[n] + fg_element.shape)))
+                images[fg_element_coords] = fg_element
+                if labelmaps is not None:
+                    map_element = np.full(fg_element.shape, idx+1, dtype=LABELMAP_DTYPE)
+                    if fine_segment:
+                        map_element[fg_element == 0] = 0
+                    labelmaps[fg_element_coords] = map_element
+                if bboxes is not None:
+                    bboxes[n, idx] = np.divide([*(fg_coords[n] + np.floor_divide(fg_element.shape,2)), *fg_element.shape], [*image_dimensions,*image_dimensions])
+            continue
+
+        # Elements looked up in the pyramid are pasted in groups of the same scale (hence of the same shape)
+        if fg_class in rescale_classes:
+            groups = [(np.flatnonzero(fg_scales == scale), scale) for scale in np.unique(fg_scales)]
+        else:
+            groups = [(np.arange(batch_size), np.nan)]
+        for group, scale in groups:
+            fg_elements = base_dataset.get_scaled(fg_class, placements["fg_indexes"][group, idx], scale)
+            element_shape = fg_elements.shape[1:]
+            group_coords, group_occlusions = fg_coords[group], fg_occlusions[group]
+
+            # Applying occlusion as a batch of square masks
+            occlusion_rows = np.arange(element_shape[0])[None, :] - group_occlusions[:, 1, None]
+            occlusion_cols = np.arange(element_shape[1])[None, :] - group_occlusions[:, 2, None]
+            occlusion_rows = (occlusion_rows >= 0) & (occlusion_rows < group_occlusions[:, 0, None])
+            occlusion_cols = (occlusion_cols >= 0) & (occlusion_cols < group_occlusions[:, 0, None])
+            occlusions = occlusion_rows[:, :, None] & occlusion_cols[:, None, :]
+            fg_elements[occlusions] = 0
+
+            # Adding fg elements and labelmap elements
+            paste_batch(images, group_coords, fg_elements, group)
+            if labelmaps is not None:
+                if fine_segment:  # If the labelmap should cut out the zero part, using the precomputed masks of base elements
+                    if np.isnan(scale):
+                        fg_masks = base_dataset.get_masks(fg_class, placements["fg_indexes"][group, idx])
+                        fg_masks[occlusions] = False
+                    else:
+                        fg_masks = fg_elements != 0
+                    map_elements = np.multiply(fg_masks, idx+1, dtype=LABELMAP_DTYPE)
+                else:
+                    map_elements = np.broadcast_to(LABELMAP_DTYPE(idx+1), fg_elements.shape)
+                paste_batch(labelmaps, group_coords, map_elements, group)
+            # Adding bounding box elements
+            if bboxes is not None:
+                bboxes[group, idx] = np.divide(np.concatenate([group_coords + np.floor_divide(element_shape, 2), np.broadcast_to(element_shape, group_coords.shape)], axis=1),
+                                               [*image_dimensions, *image_dimensions])
+
+    # Flattening images if necessary
+    if flattened:
+        images = images.reshape(batch_size, -1)
+
+    batch = {"image": images, "labelmap": labelmaps, "bboxes": bboxes, "bg_labelmap": bg_labelmaps}
+    return {key: array for key, array in batch.items() if array is not None}
+
+
+def paste_batch_torch(canvases, coords, patches, canvas_idxs=None):
+    """Pastes one patch into each canvas of a batch of tensors, as a single `index_copy_` into the flattened canvases (see
+    `paste_batch`). Each pixel is written at most once, so the copy is deterministic.
+
+    :param canvases: batch of contiguous canvases, shaped (N,H,W).
+    :param coords: top-left coordinates of each patch, shaped (N,2) (or (M,2) if canvas_idxs is given).
+    :param patches: patches to paste, shaped (N,h,w) (or (M,h,w)) or broadcastable to it, of the canvases' dtype.
+    :param canvas_idxs: (optional) indexes of the M canvases to paste into, if not all of them.
+    """
+    coords = torch.as_tensor(coords, dtype=torch.long)
+    canvas_idxs = torch.arange(len(coords)) if canvas_idxs is None else torch.as_tensor(canvas_idxs, dtype=torch.long)
+    patch_shape = patches.shape[-2:]
+    # Flat index of the top-left pixel of each patch, plus the flat offsets of the patch pixels
+    origins = (canvas_idxs * canvases.shape[1] + coords[:, 0]) * canvases.shape[2] + coords[:, 1]
+    offsets = torch.arange(patch_shape[0])[:, None] * canvases.shape[2] + torch.arange(patch_shape[1])[None, :]
+    flat_idxs = origins[:, None, None] + offsets
+    canvases.view(-1).index_copy_(0, flat_idxs.reshape(-1), patches.expand(flat_idxs.shape).reshape(-1))
+
+
+def render_batch_torch(placements, base_dataset, image_dimensions: tuple, fg_classes: list, rescale_classes: list,
+                       fine_segment: bool, flattened: bool, omission_idxs: list=None, outputs: tuple=OUTPUTS):
+    """Renders a batch of drawn placements into CloStOb images, label maps and bounding boxes, as tensors.
+
+    The values and dtypes are exactly those of `render_batch`, but elements are gathered with `index_select`, occluded
+    with batched square masks and pasted with `index_copy_` (see `paste_batch_torch`), all running on torch's intra-op
+    thread pool (see `torch.set_num_threads`). The tensors are then handed to `batch_to_tensors` without any conversion.
+    Only rescaled elements missing from the base dataset pyramid are still rescaled one by one.
+
+    :param placements: dict of the `draw_placements` arrays, stacked along a first batch axis.
+    :return: a dict of stacked tensors, as the arrays of `generate_batch`. See `generate_image` for the other
+    parameters.
+    """
+    # Casting a None omission_idxs to empty list
+    if omission_idxs is None: omission_idxs = []
+
+    # Creating empty base images and labelmaps (unrequested outputs are never built)
+    batch_size = len(placements["fg_indexes"])
+    images = torch.zeros((batch_size, *image_dimensions), dtype=torch.float32)
+    labelmaps = torch.zeros((batch_size, *image_dimensions), dtype=torch.uint8) if "labelmap" in outputs else None
+    # Bounding boxes are a handful of numbers per image: computing them as in `render_batch`
+    bboxes = np.zeros((batch_size, len(fg_classes), 4)) if "bboxes" in outputs else None
+    bg_labelmaps = torch.full((batch_size, *image_dimensions), -1, dtype=torch.int8) if "bg_labelmap" in outputs else None
+
+    # Distributing background images, one element slot at a time
+    for slot in range(placements["bg_classes"].shape[1]):
+        slot_classes = placements["bg_classes"][:, slot]
+        bg_elements = tensor_view(base_dataset.images).index_select(0, torch.as_tensor(base_dataset.global_indexes(slot_classes, placements["bg_indexes"][:, slot]), dtype=torch.long))
+        paste_batch_torch(images, placements["bg_coords"][:, slot], bg_elements.to(images.dtype))
+        if bg_labelmaps is None: continue
+        bg_map_elements = torch.as_tensor(slot_classes, dtype=torch.int8)[:, None, None].expand(bg_elements.shape)
+        if fine_segment:  # If the labelmap should cut out the zero part (the masks being the nonzero parts of images)
+            bg_map_elements = (bg_elements != 0).to(torch.int8) * bg_map_elements
+        paste_batch_torch(bg_labelmaps, placements["bg_coords"][:, slot], bg_map_elements)
+
+    # Distributing fg images, one element slot at a time
+    for idx, fg_class in enumerate(fg_classes):
+        fg_coords, fg_scales, fg_occlusions = placements["fg_coords"][:, idx], placements["fg_scales"][:, idx], placements["fg_occlusions"][:, idx]
+        # Omitted elements are drawn but never added to the images
+        if (idx+1) in omission_idxs: continue
+
+        if fg_class in rescale_classes and not all((fg_class, scale) in base_dataset.pyramid for scale in np.unique(fg_scales)):
+            # Rescaled elements have varying shapes: falling back to the per-element path
+            for n in range(batch_size):
+                fg_element = torch.from_numpy(base_dataset.get_element(fg_class, placements["fg_indexes"][n, idx], fg_scales[n], fg_occlusions[n]))
+                fg_element_coords = (n, *(np.s_[origin:end] for origin, end in zip(fg_coords[n], fg_coords[n] + fg_element.shape)))
+                images[fg_element_coords] = fg_element
+                if labelmaps is not None:
+                    labelmaps[fg_element_coords] = (fg_element != 0).to(torch.uint8) * (idx+1) if fine_segment else idx+1
+                if bboxes is not None:
+                    bboxes[n, idx] = np.divide([*(fg_coords[n] + np.floor_divide(fg_element.shape,2)), *fg_element.shape], [*image_dimensions,*image_dimensions])
+            continue
+
+        # Elements looked up in the pyramid are pasted in groups of the same scale (hence of the same shape)
+        if fg_class in rescale_classes:
+            groups = [(np.flatnonzero(fg_scales == scale), scale) for scale in np.unique(fg_scales)]
+        else:
+            groups = [(np.arange(batch_size), np.nan)]
+        for group, scale in groups:
+            fg_elements = base_dataset.get_scaled_tensor(fg_class, placements["fg_indexes"][group, idx], scale).to(images.dtype)
+            element_shape = fg_elements.shape[1:]
+            group_coords, group_occlusions = fg_coords[group], torch.as_tensor(fg_occlusions[group], dtype=torch.long)
+
+            # Applying occlusion as a batch of square masks
+            occlusion_rows = torch.arange(element_shape[0])[None, :] - group_occlusions[:, 1, None]
+            occlusion_cols = torch.arange(element_shape[1])[None, :] - group_occlusions[:, 2, None]
+            occlusion_rows = (occlusion_rows >= 0) & (occlusion_rows < group_occlusions[:, 0, None])
+            occlusion_cols = (occlusion_cols >= 0) & (occlusion_cols < group_occlusions[:, 0, None])
+            fg_elements.masked_fill_(occlusion_rows[:, :, None] & occlusion_cols[:, None, :], 0)
+
+            # Adding fg elements and labelmap elements
+            paste_batch_torch(images, group_coords, fg_elements, group)
+            if labelmaps is not None:
+                if fine_segment:  # If the labelmap should cut out the zero part
+                    map_elements = (fg_elements != 0).to(torch.uint8) * (idx+1)
+                else:
+                    map_elements = torch.full((), idx+1, dtype=torch.uint8).expand(fg_elements.shape)
+                paste_batch_torch(labelmaps, group_coords, map_elements, group)
+            # Adding bounding box elements
+            if bboxes is not None:
+                bboxes[group, idx] = np.divide(np.concatenate([group_coords + np.floor_divide(element_shape, 2), np.broadcast_to(element_shape, group_coords.shape)], axis=1),
+                                               [*image_dimensions, *image_dimensions])
+
+    # Flattening images if necessary
+    if flattened:
+        images = images.reshape(batch_size, -1)
+
+    batch = {"image": images, "labelmap": labelmaps, "bboxes": None if bboxes is None else torch.from_numpy(bboxes), "bg_labelmap": bg_labelmaps}
+    return {key: tensor for key, tensor in batch.items() if tensor is not None}
+
+
+def recipe_dtype(base_dataset, image_dimensions: tuple, num_fg: int, num_bg: int, rescaled: bool = True, occluded: bool = True):
+    """Structured dtype of sample recipes (see `generate_recipes`), with the smallest integer types fitting the base
+    dataset and the image dimensions.
+
+    :param num_fg: number of fg elements per sample.
+    :param num_bg: number of bg elements per sample.
+    :param rescaled: If True, recipes hold the fg scales. Else, no fg element is rescaled.
+    :param occluded: If True, recipes hold the fg occlusions. Else, no fg element is occluded.
+    """
+    index_dtype = np.min_scalar_type(base_dataset.class_counts.max())
+    coords_dtype = np.min_scalar_type(max(image_dimensions))
+    fields = [("seed", np.int64),
+              ("bg_classes", np.min_scalar_type(base_dataset.classes.max()), (num_bg,)),
+              ("bg_indexes", index_dtype, (num_bg,)),
+              ("bg_coords", coords_dtype, (num_bg, 2)),
+              ("fg_indexes", index_dtype, (num_fg,)),
+              ("fg_coords", coords_dtype, (num_fg, 2))]
+    if rescaled:
+        fields.append(("fg_scales", np.float64, (num_fg,)))
+    if occluded:
+        fields.append(("fg_occlusions", np.int16, (num_fg, 3)))
+    return np.dtype(fields)
+
+
+def generate_recipes(seeds, base_dataset, image_dimensions: tuple, fg_classes: list, fg_positions: list,
+                     position_translation: float, position_noise: float, rescale_classes: list,
+                     rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple,
+                     bg_classes: list, bg_amount: float, bg_bbox: tuple, rescale_levels=None, rng_scheme: str="legacy"):
+    """Draws the recipes of a batch of CloStOb samples: the compact records of their random placements, from which
+    `render_recipes` rebuilds the very same samples as `generate_batch`, without storing any pixels.
+
+    Recipes are a structured array (see `recipe_dtype`) with one record per seed, holding its "seed" and the
+    `draw_placements` fields. They can also be queried by placement without rendering anything, e.g.
+    `recipes[recipes["fg_coords"][:, 0, 1] < 40]`.
+
+    :param seeds: list of random number generator seeds, one per sample.
+    :return: the recipes array. See `generate_image` for the other parameters.
+    """
+    dtype = recipe_dtype(base_dataset, image_dimensions, len(fg_classes), bg_amount,
+                         rescaled=len(rescale_classes) > 0, occluded=len(occlusion_classes) > 0)
+    recipes = np.zeros(len(seeds), dtype=dtype)
+    recipes["seed"] = seeds
+    placements = draw_batch_placements(seeds, base_dataset, image_dimensions, fg_classes, fg_positions, position_translation,
+                                       position_noise, rescale_classes, rescale_range, occlusion_classes, occlusion_range,
+                                       bg_classes, bg_amount, bg_bbox, rescale_levels=rescale_levels, rng_scheme=rng_scheme)
+    for name in dtype.names[1:]:
+        recipes[name] = placements[name]
+    return recipes
+
+
+def render_recipes(recipes, base_dataset, image_dimensions: tuple, fg_classes: list, rescale_classes: list,
+                   fine_segment: bool, flattened: bool, omission_idxs: list=None, outputs: tuple=OUTPUTS, backend: str="numpy"):
+    """Renders a batch of sample recipes (see `generate_recipes`) back into CloStOb samples.
+
+    :param recipes: recipes array.
+    :param backend: compositor, among `BACKENDS`.
+    :return: a dict of stacked arrays, as in `generate_batch`. See `generate_image` for the other parameters.
+    """
+    num_fg = len(fg_classes)
+    placements = {name: recipes[name].astype(int) for name in ["bg_classes", "bg_indexes", "bg_coords", "fg_indexes", "fg_coords"]}
+    # Recipes without scales or occlusions are neither rescaled nor occluded
+    if "fg_scales" in recipes.dtype.names:
+        placements["fg_scales"] = recipes["fg_scales"]
+    else:
+        placements["fg_scales"] = np.full((len(recipes), num_fg), np.nan)
+    if "fg_occlusions" in recipes.dtype.names:
+        placements["fg_occlusions"] = recipes["fg_occlusions"].astype(int)
+    else:
+        placements["fg_occlusions"] = np.zeros((len(recipes), num_fg, 3), dtype=int)
+    render_fn = render_batch_torch if backend == "torch" else render_batch
+    return render_fn(placements, base_dataset, image_dimensions, fg_classes, rescale_classes, fine_segment, flattened,
+                     omission_idxs=omission_idxs, outputs=outputs)
+
+
+def generate_shift_batches(seed, base_dataset, image_dimensions: tuple, fg_classes: list, fg_positions: list,
+                           rescale_classes: list, rescale_range: tuple, occlusion_classes: list, occlusion_range: tuple,
+                           bg_classes: list, bg_amount: float, bg_bbox: tuple, fine_segment: bool, flattened: bool,
+                           reference_idx: int, reference_positions, batch_size: int, omission_idxs: list=None,
+                           rescale_levels=None, outputs: tuple=OUTPUTS, rng_scheme: str="legacy"):
+    """Lazily generates batches of one CloStOb image with its reference element shifted to several positions.
+
+    Each image is identical to `generate_image` with the reference position replaced (and no translation nor noise),
+    but the scene is only built once: everything below the reference (background and earlier fg elements) is rendered
+    a single time, and each batch only pastes the reference at its positions and re-applies the fg elements above it.
+
+    :param reference_idx: index in fg_classes of the reference element.
+    :param reference_positions: (A,2) array of normalized reference positions, as in fg_positions.
+    :param batch_size: maximum number of images per yielded batch.
+    :return: a generator of dicts of stacked arrays, as in `generate_batch`. See `generate_image` for the other
+    parameters.
+    """
+    # Casting a None omission_idxs to empty list
+    if omission_idxs is None: omission_idxs = []
+
+    # The placement draws do not depend on the fg positions, so a single draw holds for all reference positions
+    placements = draw_placements(seed, base_dataset, image_dimensions, fg_classes, fg_positions, 0, 0, rescale_classes,
+                                 rescale_range, occlusion_classes, occlusion_range, bg_classes, bg_amount, bg_bbox,
+                                 rescale_levels=rescale_levels, rng_scheme=rng_scheme)
+    # Converting the reference positions to pixel coordinates, exactly as in draw_placements
+    base_shape = base_dataset.image_shape
+    coordinates_limit = np.array(image_dimensions) - base_shape
+    reference_coords = (np.asarray(reference_positions) * image_dimensions - np.array(base_shape) // 2).astype(int)
+    reference_coords = np.clip(reference_coords, 0, coordinates_limit)
+
+    # Rendering the base scene (everything below the reference) once
+    above_idxs = range(reference_idx + 1, len(fg_classes))
+    scene = render_batch({key: value[None] for key, value in placements.items()}, base_dataset, image_dimensions,
+                         fg_classes, rescale_classes, fine_segment, False,
+                         omission_idxs=[*omission_idxs, reference_idx + 1, *(idx + 1 for idx in above_idxs)], outputs=outputs)
+
+    # Transforming the reference and above elements once, along with their labelmap elements
+    layers = {}
+    for idx in [reference_idx, *above_idxs]:
+        if (idx+1) in omission_idxs: continue
+        element = base_dataset.get_element(fg_classes[idx], placements["fg_indexes"][idx], placements["fg_scales"][idx],
+                                           placements["fg_occlusions"][idx])
+        if "labelmap" not in outputs:
+            map_element = None
+        elif fine_segment:  # If the labelmap should cut out the zero part
+            mask = base_dataset.get_element_mask(fg_classes[idx], placements["fg_indexes"][idx], placements["fg_scales"][idx],
+                                                 placements["fg_occlusions"][idx], element)
+            map_element = np.multiply(mask, idx+1, dtype=LABELMAP_DTYPE)
+        else:
+            map_element = np.full(element.shape, idx+1, dtype=LABELMAP_DTYPE)
+        layers[idx] = (element, map_element)
+
+    for start in range(0, len(reference_coords), batch_size):
+        coords = reference_coords[start:start+batch_size]
+        batch = {key: np.repeat(value, len(coords), axis=0) for key, value in scene.items()}
+
+        # Pasting the reference at each of its coordinates
+        if reference_idx in layers:
+            element, map_element = layers[reference_idx]
+            paste_batch(batch["image"], coords, element)
+            if "labelmap" in batch:
+                paste_batch(batch["labelmap"], coords, map_element)
+            if "bboxes" in batch:
+                batch["bboxes"][:, reference_idx] = np.divide(np.concatenate([coords + np.floor_divide(element.shape, 2), np.broadcast_to(element.shape, coords.shape)], axis=1),
+                                                              [*image_dimensions, *image_dimensions])
+
+        # Re-applying the fg elements above the reference, at their fixed coordinates
+        for idx in above_idxs:
+            if idx not in layers: continue
+            element, map_element = layers[idx]
+            element_coords = (slice(None), *(np.s_[origin:end] for origin, end in zip(placements["fg_coords"][idx], placements["fg_coords"][idx] + element.shape)))
+            batch["image"][element_coords] = element
+            if "labelmap" in batch:
+                batch["labelmap"][element_coords] = map_element
+            if "bboxes" in batch:
+                batch["bboxes"][:, idx] = np.divide([*(placements["fg_coords"][idx] + np.floor_divide(element.shape,2)), *element.shape], [*image_dimensions,*image_dimensions])
+
+        # Flattening images if necessary
+        if flattened:
+            batch["image"] = batch["image"].reshape(len(coords), -1)
+        yield batch
+
+
+class CloStObCache:
+    def __init__(self, cache_dir: str, max_bytes: int = None):
+        """Persistent on-disk cache of generated CloStOb datasets.
+
+        Each entry is a folder named after a hash of its generation configuration, holding one `.npy` file per
+        generated array ("image", "labelmap", "bboxes", "bg_labelmap"). Entries are opened memory-mapped, so that a
+        second run opens the dataset instantly and DataLoader workers share the same pages. Whenever the cache grows
+        over `max_bytes`, the least recently used entries are evicted. Entries left incomplete by interrupted runs
+        of this host are removed when opening the cache.
+
+        :param cache_dir: folder holding the cache entries.
+        :param max_bytes: (optional) size cap of the whole cache, in bytes. If None, the cache is unbounded.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.remove_stale_entries()
+
+    def entry_key(self, config: dict):
+        """Hashes a generation configuration into an entry key."""
+        config = dict(config, cache_version=CACHE_VERSION)
+        return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+    def entry_path(self, key: str):
+        return os.path.join(self.cache_dir, key)
+
+    def temp_path(self, key: str):
+        """Gets the temporary folder an entry is written to by this process, named after the host and process id."""
+        return self.entry_path("{}.tmp-{}-{}".format(key, socket.gethostname(), os.getpid()))
+
+    def remove_stale_entries(self):
+        """Removes the temporary folders of entries whose writing process (on this host) is not running anymore."""
+        prefix = "-{}-".format(socket.gethostname())
+        for name in os.listdir(self.cache_dir):
+            if ".tmp" + prefix not in name: continue
+            pid = int(name.rsplit("-", 1)[1])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                shutil.rmtree(self.entry_path(name), ignore_errors=True)
+            except PermissionError:
+                pass  # Running, as another user
+
+    def pyramid_path(self, base_fingerprint):
+        """Gets the folder of the rescaled base images (see `BaseDataset.build_pyramid`) of a base dataset, given its
+        fingerprint. Pyramids are not entries: they are neither counted towards `max_bytes` nor evicted."""
+        key = hashlib.sha256(json.dumps([base_fingerprint, CACHE_VERSION], default=str).encode()).hexdigest()
+        return os.path.join(self.cache_dir, "pyramid", key)
+
+    def entries(self):
+        """Lists the stored entries as (key, last access time, size in bytes) tuples, least recently used first."""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self.entry_path(key), "meta.json")
+            if not os.path.isfile(meta_path): continue  # Skipping entries still being written
+            with open(meta_path) as meta_file:
+                nbytes = json.load(meta_file)["nbytes"]
+            entries.append((key, os.path.getmtime(meta_path), nbytes))
+        return sorted(entries, key=lambda entry: entry[1])
+
+    def load(self, key: str):
+        """Opens a stored entry as a dict of read-only memory-mapped arrays, or returns None if it is not stored."""
+        entry_path = self.entry_path(key)
+        meta_path = os.path.join(entry_path, "meta.json")
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path) as meta_file:
+            names = json.load(meta_file)["arrays"]
+        os.utime(meta_path)  # Marking the entry as recently used
+        return {name: np.load(os.path.join(entry_path, name + ".npy"), mmap_mode="r") for name in names}
+
+    def store(self, key: str, config: dict, size: int, generate_fn):
+        """Generates and stores a new entry, then opens it.
+
+        :param key: entry key, as given by `entry_key(config)`.
+        :param config: generation configuration, kept alongside the entry for reference.
+        :param size: number of samples of the entry.
+        :param generate_fn: callable taking a range of sample indexes and returning a dict of stacked arrays, as
+        `generate_batch` does.
+        :return: the stored entry, as given by `load(key)`.
+        """
+        # Writing to a temporary folder first, so that concurrent runs never see partial entries
+        temp_path = self.temp_path(key)
+        os.makedirs(temp_path, exist_ok=True)
+        # Allocating the arrays from the shapes of the first batch (of a single sample, for an empty entry)
+        first_batch = generate_fn(range(max(min(PRELOAD_BATCH_SIZE, size), 1)))
+        arrays = {name: np.lib.format.open_memmap(os.path.join(temp_path, name + ".npy"), mode="w+",
+                                                  dtype=value.dtype, shape=(size, *value.shape[1:]))
+                  for name, value in first_batch.items()}
+        for batch_start in range(0, size, PRELOAD_BATCH_SIZE):
+            batch = first_batch if batch_start == 0 else generate_fn(range(batch_start, min(batch_start + PRELOAD_BATCH_SIZE, size)))
+            for name, value in batch.items():
+                arrays[name][batch_start:batch_start + len(value)] = value
+        for array in arrays.values():
+            array.flush()
+        with open(os.path.join(temp_path, "meta.json"), "w") as meta_file:
+            json.dump({"config": config, "size": size, "arrays": list(arrays),
+                       "nbytes": sum(array.nbytes for array in arrays.values())}, meta_file, default=str)
+        del arrays
+
+        # Moving the entry in place; if another run stored it in the meantime, keeping theirs
+        try:
+            os.rename(temp_path, self.entry_path(key))
+        except OSError:
+            shutil.rmtree(temp_path)
+
+        self.evict(keep=[key])
+        return self.load(key)
+
+    def invalidate(self, key: str):
+        """Removes a single entry from the cache."""
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        for key, _, _ in self.entries():
+            self.invalidate(key)
+
+    def evict(self, keep: list = ()):
+        """Evicts least recently used entries until the cache fits within `max_bytes`.
+
+        :param keep: keys of entries to never evict (e.g. the one just stored).
+        """
+        if self.max_bytes is None: return
+        entries = self.entries()
+        total_bytes = sum(nbytes for _, _, nbytes in entries)
+        for key, _, nbytes in entries:
+            if total_bytes <= self.max_bytes: break
+            if key in keep: continue
+            self.invalidate(key)
+            total_bytes -= nbytes
+
+
+def batch_to_tensors(batch):
+    """Converts a batch of generated arrays to tensors in a single pass per array.
+
+    Images are normalized from [0,255] to [-1,1] and given a channel dimension, with the very same operations as the
+    `ToTensor()` + `Normalize((255/2,), (255/2,))` transforms; labelmaps are converted as by `targetToTensor()`.
+    Arrays are converted in place, without copies.
+
+    :param batch: dict of stacked arrays (or tensors), as given by `generate_batch`.
+    :return: a dict of stacked tensors, with "image" shaped (N,1,...).
+    """
+    images = torch.as_tensor(batch["image"]).unsqueeze(1)
+    normalization = torch.as_tensor((255/2,), dtype=images.dtype).view(-1, *[1] * (images.dim() - 2))
+    images.sub_(normalization).div_(normalization)
+    return dict({key: torch.as_tensor(value) for key, value in batch.items()}, image=images)
+
+
+# Dataset being preloaded by a preload worker process
+preload_dataset = None
+
+def init_preload_worker(dataset):
+    """Initializes a preload worker process with the dataset being preloaded."""
+    global preload_dataset
+    preload_dataset = dataset
+
+def preload_batch(bounds):
+    """Preloads a batch of samples, given as index bounds, in a preload worker process."""
+    preload_dataset.preload_batch(*bounds)
 
 
 class CloStObDataset(Dataset):
@@ -160,7 +1178,9 @@ class CloStObDataset(Dataset):
                  bg_classes: list, bg_amount: float, bg_bboxes: tuple = None, position_translation: float = 0.0, position_noise: float = 0.0,
                  rescale_classes: list = [], rescale_range: tuple = (1,1), occlusion_classes: list = [], occlusion_range: tuple = (0,0),
                  fine_segment: bool = False,
-                 flattened: bool = False, lazy_load: bool = False, transform = None, target_transform = None, start_seed: int = 0):
+                 flattened: bool = False, lazy_load: bool = False, transform = None, target_transform = None, start_seed: int = 0,
+                 cache_dir: str = None, cache_max_bytes: int = None, shared_memory: bool = False, preload_workers: int = 1, to_tensor: bool = False,
+                 rescale_levels = None, outputs: tuple = None, rng_scheme: str = "legacy", backend: str = "numpy"):
         """The constructor for CloStObDataset class.
 
         :param base_dataset_name: name of the base dataset folder.
@@ -183,17 +1203,50 @@ class CloStObDataset(Dataset):
         :param transform: (optional) callable/transform to be applied to each image.
         :param target_transform: (optional) callable/transform to be applied to each labelmap.
         :param start_seed: seed to offset by.
+        :param cache_dir: (optional) folder of a persistent `CloStObCache`. If given, the generated arrays are stored there
+        on the first run and memory-mapped on the following ones, and transforms are applied on access (`lazy_load` is
+        then irrelevant).
+        :param cache_max_bytes: (optional) size cap of the cache, in bytes. Least recently used entries are evicted.
+        :param shared_memory: If True, the base dataset and the preloaded samples are stored in shared memory, which
+        DataLoader workers attach to instead of copying. They are two segments (see `ArrayStore`): the base dataset is
+        loaded once per process and shared by every dataset built on it, while each dataset has its own samples.
+        Default: False.
+        :param preload_workers: number of processes for preloading (if not `lazy_load`). Each process generates batches
+        of the seed range and writes them in place, so the samples are the same as with a single process. Default: 1.
+        :param to_tensor: If True, samples are emitted directly as tensors (see `batch_to_tensors`), numerically identical
+        to the `ToTensor()`, `Normalize((255/2,), (255/2,))` and `targetToTensor()` transforms, which must then be None.
+        Default: False.
+        :param rescale_levels: (optional) number of evenly spaced scales over `rescale_range`, or list of scales. If given,
+        the drawn scales are snapped to the nearest of these levels, and the images of the rescale classes are
+        precomputed at each level once (and stored in `cache_dir`, if given), so that elements are looked up instead of
+        rescaled. If None, elements are rescaled exactly, on the fly. Default: None.
+        :param outputs: (optional) arrays to generate, among `OUTPUTS` (e.g. ("image", "bboxes") for detection). The
+        others are neither built, stored nor transferred. "image" is always generated. Default: all of `OUTPUTS`.
+        :param rng_scheme: random number generation scheme mapping seeds to samples, among `RNG_SCHEMES`. "legacy"
+        reproduces the original samples; "philox-v1" draws every sample from a fixed place of a counter-based stream,
+        so that its draws are batched and any sample is reproduced whichever batch or shard it is drawn in. Default: "legacy".
+        :param backend: compositor of generated batches, among `BACKENDS`. "torch" composes them directly as tensors on
+        torch's thread pool (see `render_batch_torch`), with the very same values, and requires `to_tensor`. Single
+        lazily generated samples and cache entries are always composed with numpy. Default: "numpy".
         """
         # Sanity checking on parameters
         assert len(image_dimensions) == 2, "Only 2D images are currently supported"
+        assert not to_tensor or (transform is None and target_transform is None), "to_tensor replaces transform and target_transform"
+        assert outputs is None or set(outputs) <= set(OUTPUTS), "outputs must be among {}".format(OUTPUTS)
+        assert rng_scheme in RNG_SCHEMES, "rng_scheme must be one of {}".format(RNG_SCHEMES)
+        assert backend in BACKENDS, "backend must be one of {}".format(BACKENDS)
+        assert backend == "numpy" or to_tensor, "The torch backend emits tensors, and requires to_tensor"
         assert len(fg_classes) == len(fg_positions), "Length of fg_classes ({}) and fg_positions ({}) mismatch".format(
             len(fg_classes), len(fg_positions))
 
         # Loading base dataset
         self.base_dataset = load_dataset(base_dataset_name)
+        if shared_memory:
+            self.base_dataset.share_memory()
 
         # Setting flags and inner attributes
         self.lazy_load = lazy_load
+        self.to_tensor = to_tensor
         self.transform = transform
         self.target_transform = target_transform
         self.number_of_classes = 1 + len(fg_classes)
@@ -215,85 +1268,379 @@ class CloStObDataset(Dataset):
         self.flattened = flattened
         self.fine_segment = fine_segment
         self.start_seed = start_seed
+        self.rng_scheme = rng_scheme
+        self.backend = backend
+        self.outputs = OUTPUTS if outputs is None else tuple(key for key in OUTPUTS if key == "image" or key in outputs)
 
-        # If preloading, generate a list of CloStOb images and apply transforms
-        if not self.lazy_load:
-            self.samples = [self.apply_transforms(generate_image(i+start_seed, self.base_dataset, self.image_dimensions, self.fg_classes, self.fg_positions, self.position_translation, self.position_noise, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, self.fine_segment, self.flattened)) for i in range(size)]
-
+        self.base_dataset_name = base_dataset_name
         self.size = size
+        self.cache = CloStObCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+
+        # If quantizing scales, precompute the rescaled images at each level
+        self.rescale_levels = None
+        if rescale_levels is not None and len(rescale_classes) > 0:
+            if isinstance(rescale_levels, int):
+                rescale_levels = np.linspace(rescale_range[0], rescale_range[1], rescale_levels)
+            self.rescale_levels = np.asarray(rescale_levels, dtype=float)
+            pyramid_path = self.cache.pyramid_path(base_dataset_fingerprint(base_dataset_name)) if self.cache is not None else None
+            self.base_dataset.build_pyramid(rescale_classes, self.rescale_levels, pyramid_path)
+
+        # If caching, open the stored arrays (generating and storing them on the first run)
+        self.cached_samples = None
+        if self.cache is not None:
+            self.cache_key = self.cache.entry_key(self.cache_config())
+            self.open_cache()
+
+        # If preloading, generate CloStOb images (batch by batch), apply transforms and store them contiguously
+        elif not self.lazy_load:
+            # Getting a first sample for preallocating the storage; workers need it in shared memory to write to it
+            self.samples = SampleStore(size, self.apply_transforms({key: value[0] for key, value in self.generate_batch([0]).items()}),
+                                       shared=shared_memory or preload_workers > 1)
+            batch_bounds = [(batch_start, min(batch_start+PRELOAD_BATCH_SIZE, size)) for batch_start in range(0, size, PRELOAD_BATCH_SIZE)]
+            if preload_workers > 1:
+                with multiprocessing.Pool(preload_workers, initializer=init_preload_worker, initargs=(self,)) as pool:
+                    pool.map(preload_batch, batch_bounds)
+            else:
+                for bounds in batch_bounds:
+                    self.preload_batch(*bounds)
+
+    def open_cache(self):
+        """Opens the cached arrays of the dataset, memory-mapped, generating and storing them first if needed."""
+        self.cached_samples = self.cache.load(self.cache_key)
+        if self.cached_samples is None:
+            self.cached_samples = self.cache.store(self.cache_key, self.cache_config(), self.size, lambda idxs: self.generate_batch(idxs, backend="numpy"))
+
+    def __getstate__(self):
+        # Cached arrays are memory-mapped again from the cache (e.g. by spawned DataLoader workers), sharing the same
+        # pages, rather than pickled by value
+        return dict(self.__dict__, cached_samples=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cache is not None:
+            self.open_cache()
 
     def __getitem__(self, idx):
-        if not self.lazy_load:
+        # Slices and lists of indexes (e.g. from CloStObBatchSampler) return whole batches
+        if isinstance(idx, (slice, list)):
+            return self.get_batch(idx)
+
+        if self.cached_samples is not None:
+            sample = self.apply_transforms({key: np.array(value[idx]) for key, value in self.cached_samples.items()})
+        elif not self.lazy_load:
             sample = self.samples[idx]
         else:
-            sample = generate_image(idx + self.start_seed, self.base_dataset, self.image_dimensions, self.fg_classes, self.fg_positions, self.position_translation, self.position_noise, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, self.fine_segment, self.flattened)
+            sample = generate_image(idx + self.start_seed, self.base_dataset, self.image_dimensions, self.fg_classes, self.fg_positions, self.position_translation, self.position_noise, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, self.fine_segment, self.flattened, rescale_levels=self.rescale_levels, outputs=self.outputs, rng_scheme=self.rng_scheme)
             sample = self.apply_transforms(sample)
         return sample
 
     def __len__(self):
         return self.size
 
+    def get_batch(self, idxs):
+        """Gets a batch of samples as a dict of stacked tensors.
+
+        :param idxs: a slice or a list of indexes. Preloaded samples are returned as views of the storage for slices, or
+        `index_select` copies for lists.
+        """
+        if not self.lazy_load and self.cached_samples is None:
+            return self.samples.get_batch(idxs)
+        if isinstance(idxs, slice):
+            idxs = range(*idxs.indices(self.size))
+        if self.cached_samples is not None:
+            batch = {key: np.asarray(value[list(idxs)]) for key, value in self.cached_samples.items()}
+        else:
+            batch = self.generate_batch(idxs)
+        return self.transform_batch(batch)
+
+    def __getitems__(self, idxs):
+        """Gets a whole batch at once (see `get_batch`); called by DataLoaders instead of one `__getitem__` per index.
+        The batch is returned as a `CollatedBatch`: DataLoaders using `collate_fn=collate_batch` take it as is, while the
+        default collate function stacks its samples again."""
+        return CollatedBatch(self.get_batch(list(idxs)))
+
+    def transform_batch(self, batch):
+        """Applies the transforms to a batch of generated arrays, and stacks it into a dict of tensors.
+
+        :param batch: dict of stacked arrays, as given by `generate_batch`.
+        """
+        if self.to_tensor:
+            return batch_to_tensors(batch)
+        samples = [self.apply_transforms({key: value[i] for key, value in batch.items()}) for i in range(len(batch["image"]))]
+        return {key: torch.stack([torch.as_tensor(sample[key]) for sample in samples]) for key in batch}
+
+    def generate_batch(self, idxs, backend: str = None):
+        """Generates the (untransformed) samples of the given indexes as a dict of stacked arrays (or tensors, with the
+        torch backend).
+
+        :param backend: (optional) compositor overriding the dataset's `backend`.
+        """
+        backend = self.backend if backend is None else backend
+        return generate_batch([idx + self.start_seed for idx in idxs], self.base_dataset, self.image_dimensions, self.fg_classes, self.fg_positions, self.position_translation, self.position_noise, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, self.fine_segment, self.flattened, rescale_levels=self.rescale_levels, outputs=self.outputs, rng_scheme=self.rng_scheme, backend=backend)
+
+    def generate_recipes(self, idxs):
+        """Draws the recipes of the samples of the given indexes (see `generate_recipes`)."""
+        return generate_recipes([idx + self.start_seed for idx in idxs], self.base_dataset, self.image_dimensions, self.fg_classes, self.fg_positions, self.position_translation, self.position_noise, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, rescale_levels=self.rescale_levels, rng_scheme=self.rng_scheme)
+
+    def render_recipes(self, recipes, omission_idxs=None):
+        """Renders recipes (see `generate_recipes`) into a batch of transformed samples, as given by `get_batch`.
+
+        :param recipes: recipes array, drawn with this dataset's parameters.
+        :param omission_idxs: (optional) list of fg element indexes (starting at 1) to omit.
+        """
+        return self.transform_batch(render_recipes(recipes, self.base_dataset, self.image_dimensions, self.fg_classes, self.rescale_classes, self.fine_segment, self.flattened, omission_idxs=omission_idxs, outputs=self.outputs, backend=self.backend))
+
+    def preload_batch(self, start, stop):
+        """Generates, transforms and stores the preloaded samples of indexes [start, stop)."""
+        self.samples.write(start, self.transform_batch(self.generate_batch(range(start, stop))))
+
+    def cache_config(self):
+        """Gets every parameter determining the generated arrays, for keying the cache."""
+        return {"base_dataset": base_dataset_fingerprint(self.base_dataset_name), "image_dimensions": list(self.image_dimensions), "size": self.size,
+                "fg_classes": list(self.fg_classes), "fg_positions": np.asarray(self.fg_positions).tolist(),
+                "position_translation": self.position_translation, "position_noise": self.position_noise,
+                "rescale_classes": list(self.rescale_classes), "rescale_range": list(self.rescale_range),
+                "occlusion_classes": list(self.occlusion_classes), "occlusion_range": list(self.occlusion_range),
+                "bg_classes": list(self.bg_classes), "bg_amount": self.bg_amount, "bg_bboxes": list(self.bg_bboxes),
+                "fine_segment": self.fine_segment, "flattened": self.flattened, "start_seed": self.start_seed,
+                "rescale_levels": None if self.rescale_levels is None else self.rescale_levels.tolist(), "outputs": list(self.outputs),
+                "rng_scheme": self.rng_scheme}
+
     def apply_transforms(self, sample):
         """ Applies relevant transforms to sample.
 
         :param sample: dict containing a single sample's "image" and "labelmap".
         :return: the sample, after in-place transformations.
         """
+        if self.to_tensor:
+            return {key: value[0] for key, value in batch_to_tensors({key: value[None] for key, value in sample.items()}).items()}
         if self.transform is not None:
             sample["image"] = self.transform(sample["image"])
-        if self.target_transform is not None:
+        if self.target_transform is not None and "labelmap" in sample:
             sample["labelmap"] = self.target_transform(sample["labelmap"])
         return sample
     
-    def generate_meaningless_image(self, idx, omitted_classes, add_bg_noise=False):
-        """Generates an image with meaningless information and some classes omitted.
-        
-        :param omitted_classes: list of classes to not be added to the image.
-        :param add_bg_noise: If True, random noise images are added."""
+    def generate_meaningless_batch(self, indices, omission_sets, add_bg_noise=False):
+        """Generates a batch of images with meaningless information and some classes omitted.
+
+        Every image is generated with its own index as seed; its noise comes from a separate stream of the same seed, so
+        that each index gets the same (reproducible) noise in every omission set.
 
-        # Generating a normal CSO image
-        sample = generate_image(idx, self.base_dataset, self.image_dimensions, self.fg_classes, self.fg_positions, self.position_translation, self.position_noise, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, self.fine_segment, self.flattened)
+        :param indices: list of N image indexes (seeds).
+        :param omission_sets: list of S lists of classes to not be added to the images.
+        :param add_bg_noise: If True, random noise images are added.
+        :return: a dict of stacked tensors (see `get_batch`) of S*N samples, ordered by omission set, then by index.
+        """
+        batch = generate_batch(list(indices), self.base_dataset, self.image_dimensions, self.fg_classes, self.fg_positions, self.position_translation, self.position_noise, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, self.fine_segment, self.flattened, rescale_levels=self.rescale_levels, rng_scheme=self.rng_scheme)
+        images = batch["image"]
 
-        # Generating pure uniform noise image in the [0,256] range
-        meaningless_image = np.random.randint(low=0, high=256, size=sample["image"].shape)
-        meaningless_image = meaningless_image.astype(sample["image"].dtype)
+        # Generating pure uniform noise images in the [0,256] range, one seeded stream per index
+        noise = np.stack([np.random.default_rng(np.random.SeedSequence(idx, spawn_key=(1,))).integers(low=0, high=256, size=images.shape[1:])
+                          for idx in indices]).astype(images.dtype)
 
+        # Looking up which labels keep their original pixels, for each omission set (label 0 never does)
+        kept_labels = np.array([[False] + [fg_class not in omitted_classes for fg_class in self.fg_classes] for omitted_classes in omission_sets])
+        kept = kept_labels[:, batch["labelmap"]]
         # Adding bg/noise objects if requested
         if add_bg_noise:
-            meaningless_image[sample["bg_labelmap"] > 0] = sample["image"][sample["bg_labelmap"] > 0]
+            kept |= batch["bg_labelmap"] > 0
+        meaningless_images = np.where(kept.reshape(len(omission_sets), *images.shape), images, noise)
 
-        # Adding non-omitted objects of interest
-        for class_idx, fg_class in enumerate(self.fg_classes):
-            if fg_class in omitted_classes: continue  # Skip classes to omit
-            meaningless_image[sample["labelmap"] == class_idx+1] = sample["image"][sample["labelmap"] == class_idx+1]
-        
-        # Replacing image in sample
-        sample["image"] = meaningless_image
+        # Replacing images in the batch, repeated for each omission set (with the requested outputs only)
+        batch = {key: np.concatenate([value] * len(omission_sets)) for key, value in batch.items() if key != "image" and key in self.outputs}
+        batch["image"] = meaningless_images.reshape(-1, *images.shape[1:])
 
         # Applying requested transforms
-        if self.transform is not None:
-            sample["image"] = self.transform(sample["image"])
-        return sample
+        return self.transform_batch(batch)
+
+    def generate_meaningless_image(self, idx, omitted_classes, add_bg_noise=False):
+        """Generates an image with meaningless information and some classes omitted (see `generate_meaningless_batch`).
+        
+        :param omitted_classes: list of classes to not be added to the image.
+        :param add_bg_noise: If True, random noise images are added."""
+        batch = self.generate_meaningless_batch([idx], [omitted_classes], add_bg_noise=add_bg_noise)
+        return {key: value[0] for key, value in batch.items()}
     
-    def generate_reference_shifts(self, idx, reference_class, omission_idxs=None, stride=32, element_shape=(28,28)):
-        """Generates a set of images with shifted references."""
-        set_of_shifts = []
-        shifted_fg_positions = self.fg_positions
+    def reference_anchors(self, stride=32, element_shape=(28,28)):
+        """Gets the grid of (x,y) top-left anchors the reference is shifted over (see `iter_reference_shifts`)."""
+        return [(x,y) for x in range(0, self.image_dimensions[0]-element_shape[0], stride) for y in range(0, self.image_dimensions[1]-element_shape[1], stride)]
+
+    def iter_reference_shifts(self, idx, reference_class, omission_idxs=None, stride=32, element_shape=(28,28), batch_size=64):
+        """Lazily generates transformed batches of an image with its reference shifted over a grid of anchors.
+
+        The image is generated with seed `idx`, without translation nor noise; its base scene is only built once (see
+        `generate_shift_batches`).
+
+        :param idx: seed of the image to shift the reference of.
+        :param reference_class: fg class of the reference element.
+        :param omission_idxs: (optional) list of fg element indexes (starting at 1) to omit.
+        :param stride: stride, in pixels, of the anchor grid.
+        :param element_shape: shape of the reference element, to keep it inside the image.
+        :param batch_size: maximum number of shifted images per batch.
+        :return: a generator of (batch, anchors) pairs, where batch is a dict of stacked tensors (see `get_batch`) and
+        anchors is the list of (x,y) top-left anchors of its images.
+        """
         idx_to_shift = self.fg_classes.index(reference_class)
-        normed_element_shape = ((element_shape[0]//2)/self.image_dimensions[0],
-                                (element_shape[1]//2)/self.image_dimensions[1])
-        
-        set_of_anchors = [(x,y) for x in range(0, self.image_dimensions[0]-element_shape[0], stride) for y in range(0, self.image_dimensions[1]-element_shape[1], stride)]
-        for x_anchor_base, y_anchor_base in set_of_anchors:
-                # Putting the reference in its proper place
-                x_anchor, y_anchor = x_anchor_base/self.image_dimensions[0], y_anchor_base/self.image_dimensions[1]
-                shifted_fg_positions[idx_to_shift] = (x_anchor + normed_element_shape[0], y_anchor + normed_element_shape[1])
-
-                sample = generate_image(idx, self.base_dataset, self.image_dimensions, self.fg_classes, shifted_fg_positions, 0, 0, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, self.fine_segment, self.flattened, omission_idxs=omission_idxs)
-                sample = self.apply_transforms(sample)
-                set_of_shifts.append(sample)
+        anchors = self.reference_anchors(stride, element_shape)
+        # Putting the reference at the center of each anchored element
+        normed_element_shape = ((element_shape[0]//2)/self.image_dimensions[0], (element_shape[1]//2)/self.image_dimensions[1])
+        reference_positions = [(x_anchor/self.image_dimensions[0] + normed_element_shape[0], y_anchor/self.image_dimensions[1] + normed_element_shape[1])
+                               for x_anchor, y_anchor in anchors]
+
+        batches = generate_shift_batches(idx, self.base_dataset, self.image_dimensions, self.fg_classes, self.fg_positions, self.rescale_classes, self.rescale_range, self.occlusion_classes, self.occlusion_range, self.bg_classes, self.bg_amount, self.bg_bboxes, self.fine_segment, self.flattened,
+                                         idx_to_shift, reference_positions, batch_size, omission_idxs=omission_idxs, rescale_levels=self.rescale_levels, outputs=self.outputs, rng_scheme=self.rng_scheme)
+        for start, batch in zip(range(0, len(anchors), batch_size), batches):
+            yield self.transform_batch(batch), anchors[start:start+batch_size]
+
+    def generate_reference_shifts(self, idx, reference_class, omission_idxs=None, stride=32, element_shape=(28,28)):
+        """Generates a set of images with shifted references, as a list of samples and a list of their anchors (see
+        `iter_reference_shifts`)."""
+        set_of_shifts, set_of_anchors = [], []
+        for batch, anchors in self.iter_reference_shifts(idx, reference_class, omission_idxs=omission_idxs, stride=stride, element_shape=element_shape):
+            set_of_shifts.extend({key: value[i] for key, value in batch.items()} for i in range(len(anchors)))
+            set_of_anchors.extend(anchors)
         return set_of_shifts, set_of_anchors
 
+class CloStObBatchSampler(Sampler):
+    def __init__(self, data_source, batch_size: int, shuffle: bool = False, drop_last: bool = False, generator=None):
+        """Sampler yielding whole batches of indexes, to be used as a DataLoader `sampler` with `batch_size=None`.
+
+        Unshuffled batches are yielded as slices, which CloStObDataset serves as views of its preloaded storage; shuffled
+        batches are yielded as lists of indexes, served with a single `index_select`. Lists also work through `Subset`s
+        (e.g. from `random_split`).
+
+        :param data_source: dataset to sample from.
+        :param batch_size: number of samples per batch.
+        :param shuffle: If True, samples are shuffled at every epoch.
+        :param drop_last: If True, the last incomplete batch is dropped.
+        :param generator: (optional) torch.Generator for shuffling.
+        """
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __iter__(self):
+        size = len(self.data_source)
+        if self.shuffle:
+            permutation = torch.randperm(size, generator=self.generator).tolist()
+        for batch_start in range(0, size, self.batch_size):
+            batch_stop = min(batch_start + self.batch_size, size)
+            if self.drop_last and batch_stop - batch_start < self.batch_size: break
+            yield permutation[batch_start:batch_stop] if self.shuffle else slice(batch_start, batch_stop)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.data_source) // self.batch_size
+        return -(-len(self.data_source) // self.batch_size)
+
+
+class IterableCloStObDataset(IterableDataset):
+    def __init__(self, dataset: CloStObDataset, batch_size: int, samples_per_epoch: int = None, seed_offset: int = 0,
+                 drop_last: bool = False, rank: int = None, world_size: int = None):
+        """Streams batches of CloStOb samples, generated on the fly from consecutive seeds, to be used as a DataLoader
+        dataset with `batch_size=None`.
+
+        Sample `k` of the stream is the sample of index `seed_offset + k` of `dataset` (i.e. seed
+        `dataset.start_seed + seed_offset + k`), whatever the dataset size. Epoch `e` holds samples
+        [e*samples_per_epoch, (e+1)*samples_per_epoch) of the stream, or the whole (unbounded) stream if
+        `samples_per_epoch` is None. Batches of consecutive samples are dealt out in turn to each process of
+        `torch.distributed` (if initialized), then to each DataLoader worker of a process, so that shards are disjoint
+        and each process receives its batches in stream order. Training can be resumed deterministically by passing the
+        number of samples already seen as `seed_offset`.
+
+        :param dataset: CloStOb dataset to generate samples with. Its parameters, transforms and `rng_scheme` are used
+        (the "philox-v1" scheme draws each batch at once), but nothing is preloaded or stored from it.
+        :param batch_size: number of samples per batch.
+        :param samples_per_epoch: (optional) number of samples of an epoch. If None, iterating never ends.
+        :param seed_offset: index of the first sample of the stream. Default: 0.
+        :param drop_last: If True, the last incomplete batch of an epoch is dropped, as well as the last batches that
+        cannot be dealt out to every process. If False, the epoch is padded instead with the first batches of the epoch
+        (as `DistributedSampler` does with samples). Either way, all processes run the same number of steps. Default:
+        False.
+        :param rank: (optional) rank of this process. Default: the `torch.distributed` rank, if initialized, else 0.
+        :param world_size: (optional) number of processes. Default: the `torch.distributed` world size, if
+        initialized, else 1.
+        """
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.samples_per_epoch = samples_per_epoch
+        self.seed_offset = seed_offset
+        self.drop_last = drop_last
+        self.rank = rank if rank is not None else (torch.distributed.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (torch.distributed.get_world_size() if distributed else 1)
+        self.epoch = 0
+        assert 0 <= self.rank < self.world_size, "rank ({}) must be in [0, world_size ({}))".format(self.rank, self.world_size)
+
+    def set_epoch(self, epoch: int):
+        """Sets the epoch of the next iteration (as with `DistributedSampler`); has no effect on unbounded streams."""
+        self.epoch = epoch
+
+    def num_batches(self):
+        """Gets the number of batches of an epoch, over all processes (including the batches repeated as padding)."""
+        if self.drop_last:
+            num_batches = self.samples_per_epoch // self.batch_size
+            return num_batches - num_batches % self.world_size
+        num_batches = -(-self.samples_per_epoch // self.batch_size)
+        return -(-num_batches // self.world_size) * self.world_size if num_batches > 0 else 0
+
+    def __iter__(self):
+        # Shard of this process and DataLoader worker
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        shard, num_shards = self.rank + self.world_size * worker_id, self.world_size * num_workers
+
+        if self.samples_per_epoch is None:
+            epoch_start, batch_idxs = self.seed_offset, itertools.count(shard, num_shards)
+        else:
+            epoch_start, batch_idxs = self.seed_offset + self.epoch * self.samples_per_epoch, range(shard, self.num_batches(), num_shards)
+        for batch_idx in batch_idxs:
+            if self.samples_per_epoch is not None:
+                batch_idx %= -(-self.samples_per_epoch // self.batch_size)  # Padding batches repeat the first ones
+            batch_start = batch_idx * self.batch_size
+            batch_stop = batch_start + self.batch_size
+            if self.samples_per_epoch is not None:
+                batch_stop = min(batch_stop, self.samples_per_epoch)
+            yield self.dataset.transform_batch(self.dataset.generate_batch(range(epoch_start + batch_start, epoch_start + batch_stop)))
+
+    def __len__(self):
+        """Gets the number of batches of an epoch received by this process."""
+        if self.samples_per_epoch is None:
+            raise TypeError("An unbounded IterableCloStObDataset has no length")
+        return len(range(self.rank, self.num_batches(), self.world_size))
+
+
+class CollatedBatch(list):
+    def __init__(self, batch: dict):
+        """A batch generated as a whole, as returned by `__getitems__`.
+
+        It is a list of single samples (views of the stacked tensors), so that the default collate function still
+        works, and it keeps the stacked tensors in `batch` for `collate_batch` to return without copies. Only the
+        stacked tensors are pickled (e.g. from DataLoader workers).
+
+        :param batch: dict of stacked tensors, as given by `get_batch`.
+        """
+        super().__init__({key: value[i] for key, value in batch.items()} for i in range(len(batch["image"])))
+        self.batch = batch
+
+    def __reduce__(self):
+        return CollatedBatch, (self.batch,)
+
+
+def collate_batch(batch):
+    """Collates a batch returned as a whole by CloStObDataset.
+
+    Lists of single samples (e.g. from a ConcatDataset) fall back to the default collate function.
+    """
+    if isinstance(batch, CollatedBatch):
+        batch = batch.batch
+    if not isinstance(batch, dict):
+        return default_collate(batch)
+    return {key: torch.as_tensor(value) for key, value in batch.items()}
+
+
 #%%
 if __name__ == '__main__':
     test_set_size = 20
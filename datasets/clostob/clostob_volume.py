@@ -0,0 +1,246 @@
+"""Volumetric CloStOb PyTorch Dataset class.
+
+This file contains the class for generating a PyTorch dataset of 3D CloStOb volumes, for `UNet3D`, stored chunk by
+chunk in memory-mapped arrays.
+
+Authors
+-------
+ * Mateus Riva (mateus.riva@telecom-paris.fr)"""
+#%%
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from torch.utils.data import Dataset
+
+from datasets.clostob.clostob_dataset import (load_dataset, base_dataset_fingerprint, batch_to_tensors, CollatedBatch,
+                                              OUTPUTS, LABELMAP_DTYPE, BG_LABELMAP_DTYPE, CACHE_VERSION)
+
+# Number of slices of a volume rendered at once
+CHUNK_DEPTH = 16
+
+
+def draw_volume_placements(seed, base_dataset, volume_dimensions: tuple, fg_classes: list, fg_positions: list,
+                           position_translation: float, position_noise: float, bg_classes: list, bg_amount: int,
+                           bg_bbox: tuple, element_depth: int):
+    """Draws the random placement parameters of a single CloStOb volume, all elements at once.
+
+    Every element is a stack of `element_depth` base images of its class (drawn independently), i.e. a block of
+    (element_depth, h, w) voxels.
+
+    :param seed: Random number generator seed for this volume.
+    :param base_dataset: loaded base dataset.
+    :param volume_dimensions: (D,H,W) dimensions of the volume.
+    :param fg_classes: list of class labels to be considered foreground.
+    :param fg_positions: list of normalised (z,y,x) coordinates of the center of each foreground element.
+    :param position_translation: maximal grouped foreground translation, as a percentage, along each axis.
+    :param position_noise: maximal individual foreground positional noise, as a percentage, along each axis.
+    :param bg_classes: list of class labels to be added to the background.
+    :param bg_amount: number of random elements to add to the background.
+    :param bg_bbox: normalised limit coordinates for the bg elements, as (z_min,y_min,x_min,z_max,y_max,x_max).
+    :param element_depth: number of stacked slices of each element.
+    :return: a dict containing "bg_classes", "bg_indexes" (B,element_depth) and top-left-front "bg_coords" (B,3) of the
+    background elements, and "fg_indexes" (F,element_depth) and "fg_coords" (F,3) of the foreground elements.
+    """
+    rng = np.random.default_rng(seed)
+    volume_dimensions = np.array(volume_dimensions)
+    element_shape = np.array([element_depth, *base_dataset.image_shape])
+    coordinates_limit = volume_dimensions - element_shape
+    assert np.all(coordinates_limit >= 0), "Elements ({}) must fit in the volume ({})".format(element_shape, volume_dimensions)
+
+    # Choosing background elements and their coordinates, bound to the bg_bbox
+    bg_chosen_classes = rng.choice(bg_classes, bg_amount, replace=True)
+    bg_indexes = rng.integers(0, base_dataset.class_counts[bg_chosen_classes][:, None], size=(bg_amount, element_depth))
+    bg_low = np.maximum(0, np.multiply(bg_bbox[:3], volume_dimensions)).astype(int)
+    bg_high = np.minimum(coordinates_limit, np.multiply(bg_bbox[3:], volume_dimensions)).astype(int)
+    bg_coords = rng.integers(bg_low, np.maximum(bg_high, bg_low + 1), size=(bg_amount, 3))
+
+    # Choosing fg elements, then their coordinates with global translation and individual noise
+    fg_counts = base_dataset.class_counts[np.asarray(fg_classes, dtype=int)]
+    fg_indexes = rng.integers(0, fg_counts[:, None], size=(len(fg_classes), element_depth))
+    fg_positions = np.array(fg_positions, dtype=float)
+    fg_positions += rng.uniform(-position_translation / 2, position_translation / 2, size=3)
+    fg_positions += rng.uniform(-position_noise / 2, position_noise / 2, size=fg_positions.shape)
+    fg_coords = np.clip((fg_positions * volume_dimensions - element_shape // 2).astype(int), 0, coordinates_limit)
+
+    return {"bg_classes": bg_chosen_classes, "bg_indexes": bg_indexes, "bg_coords": bg_coords,
+            "fg_indexes": fg_indexes, "fg_coords": fg_coords}
+
+
+def render_volume_chunk(placements, base_dataset, volume_dimensions: tuple, fg_classes: list, chunk_bounds: tuple,
+                        fine_segment: bool, omission_idxs: list=None, outputs: tuple=OUTPUTS):
+    """Renders slices [start, stop) of a CloStOb volume. Each element overlapping the chunk is gathered as a single
+    stack of its slices in the chunk, and pasted as a single block (bg elements first, then fg elements in order).
+
+    :param placements: placements of the volume, as given by `draw_volume_placements`.
+    :param chunk_bounds: (start, stop) slices of the chunk.
+    :return: a dict of the chunk arrays "image", "labelmap" and "bg_labelmap", shaped (stop-start,H,W), for the
+    requested outputs. See `draw_volume_placements` and `generate_image` for the other parameters.
+    """
+    if omission_idxs is None: omission_idxs = []
+    start, stop = chunk_bounds
+    chunk_shape = (stop - start, *volume_dimensions[1:])
+    image = np.zeros(chunk_shape, dtype="float32")
+    labelmap = np.zeros(chunk_shape, dtype=LABELMAP_DTYPE) if "labelmap" in outputs else None
+    bg_labelmap = np.full(chunk_shape, -1, dtype=BG_LABELMAP_DTYPE) if "bg_labelmap" in outputs else None
+
+    # Elements in painting order, as (class, slice indexes, coordinates, fg label or 0 for bg elements)
+    elements = [(cls, indexes, coords, 0) for cls, indexes, coords in zip(placements["bg_classes"], placements["bg_indexes"], placements["bg_coords"])]
+    elements += [(cls, placements["fg_indexes"][idx], placements["fg_coords"][idx], idx+1)
+                 for idx, cls in enumerate(fg_classes) if (idx+1) not in omission_idxs]
+    for cls, indexes, coords, label in elements:
+        # Slices of the element within the chunk
+        first, last = max(coords[0], start), min(coords[0] + len(indexes), stop)
+        if first >= last: continue
+        element = base_dataset.get(cls, indexes[first - coords[0]:last - coords[0]])
+        block = np.s_[first - start:last - start, coords[1]:coords[1] + element.shape[1], coords[2]:coords[2] + element.shape[2]]
+
+        image[block] = element
+        if label == 0:
+            if bg_labelmap is not None:
+                bg_labelmap[block] = (element != 0) * cls if fine_segment else cls
+        elif labelmap is not None:
+            labelmap[block] = (element != 0) * label if fine_segment else label
+
+    chunk = {"image": image, "labelmap": labelmap, "bg_labelmap": bg_labelmap}
+    return {key: array for key, array in chunk.items() if array is not None}
+
+
+def volume_bboxes(placements, base_dataset, volume_dimensions: tuple, element_depth: int, omission_idxs: list=None):
+    """Computes the 3D bounding boxes of the fg elements of a volume, as (z,y,x) centers followed by (d,h,w) shapes,
+    normalised by the volume dimensions. Omitted elements have null boxes."""
+    element_shape = np.array([element_depth, *base_dataset.image_shape])
+    bboxes = np.divide(np.concatenate([placements["fg_coords"] + element_shape // 2, np.broadcast_to(element_shape, placements["fg_coords"].shape)], axis=1),
+                       [*volume_dimensions, *volume_dimensions])
+    if omission_idxs:
+        bboxes[np.asarray(omission_idxs) - 1] = 0
+    return bboxes
+
+
+def generate_volume(seed, base_dataset, volume_dimensions: tuple, fg_classes: list, fg_positions: list,
+                    position_translation: float, position_noise: float, bg_classes: list, bg_amount: int,
+                    bg_bbox: tuple, element_depth: int, fine_segment: bool, omission_idxs: list=None,
+                    outputs: tuple=OUTPUTS, chunk_depth: int=CHUNK_DEPTH, out: dict=None):
+    """Generates a single CloStOb volume, chunk by chunk.
+
+    :param out: (optional) dict of preallocated (e.g. memory-mapped) arrays to write each chunk into, with a key for
+    each requested output. If None, new arrays are allocated.
+    :param chunk_depth: number of slices rendered at once.
+    :return: a dict of "image" (D,H,W), "labelmap" (D,H,W), "bboxes" (F,6) and "bg_labelmap" (D,H,W) arrays, for the
+    requested outputs. See `draw_volume_placements` for the other parameters.
+    """
+    placements = draw_volume_placements(seed, base_dataset, volume_dimensions, fg_classes, fg_positions,
+                                        position_translation, position_noise, bg_classes, bg_amount, bg_bbox, element_depth)
+    dtypes = {"image": np.float32, "labelmap": LABELMAP_DTYPE, "bg_labelmap": BG_LABELMAP_DTYPE}
+    if out is None:
+        out = {key: np.empty(volume_dimensions, dtype=dtype) for key, dtype in dtypes.items() if key in outputs}
+    for start in range(0, volume_dimensions[0], chunk_depth):
+        chunk_bounds = (start, min(start + chunk_depth, volume_dimensions[0]))
+        chunk = render_volume_chunk(placements, base_dataset, volume_dimensions, fg_classes, chunk_bounds, fine_segment,
+                                    omission_idxs, outputs)
+        for key, array in chunk.items():
+            out[key][chunk_bounds[0]:chunk_bounds[1]] = array
+    if "bboxes" in outputs:
+        out["bboxes"] = volume_bboxes(placements, base_dataset, volume_dimensions, element_depth, omission_idxs)
+    return {key: out[key] for key in OUTPUTS if key in outputs}
+
+
+class VolumeCloStObDataset(Dataset):
+    def __init__(self, base_dataset_name: str, volume_dimensions: tuple, size: int, output_path: str, fg_classes: list,
+                 fg_positions: list, bg_classes: list, bg_amount: int, bg_bbox: tuple = (0,0,0,1,1,1),
+                 position_translation: float = 0.0, position_noise: float = 0.0, element_depth: int = 1,
+                 fine_segment: bool = False, start_seed: int = 0, to_tensor: bool = False, outputs: tuple = None,
+                 chunk_depth: int = CHUNK_DEPTH):
+        """The constructor for VolumeCloStObDataset class.
+
+        The volumes are generated once, chunk by chunk, straight into memory-mapped arrays in `output_path` (one
+        (size,D,H,W) .npy file per output), which are opened again on the following runs. Memory use is thus bounded
+        by the chunk size, and datasets larger than RAM are streamed from disk. As in `CloStObCache`, the arrays are
+        stored in a sub-folder named after a hash of their configuration, and written to a temporary folder, completed
+        by a "meta.json" file, then moved in place, so that an interrupted generation is never opened.
+
+        :param volume_dimensions: (D,H,W) dimensions of the volumes.
+        :param output_path: folder holding the memory-mapped arrays of each configuration (including the base dataset
+        files).
+        :param element_depth: number of stacked base images in each element. Default: 1.
+        :param to_tensor: If True, samples are emitted as tensors, normalized as by `batch_to_tensors`, with images shaped
+        (1,D,H,W) for `UNet3D`. Else, samples are arrays. Default: False.
+        :param chunk_depth: number of slices rendered at once. Default: `CHUNK_DEPTH`.
+
+        See `draw_volume_placements` and `CloStObDataset` for the other parameters.
+        """
+        assert len(volume_dimensions) == 3, "Volumes must be 3D"
+        assert outputs is None or set(outputs) <= set(OUTPUTS), "outputs must be among {}".format(OUTPUTS)
+        assert len(fg_classes) == len(fg_positions), "Length of fg_classes ({}) and fg_positions ({}) mismatch".format(
+            len(fg_classes), len(fg_positions))
+        self.volume_dimensions = tuple(volume_dimensions)
+        self.size = size
+        self.number_of_classes = 1 + len(fg_classes)
+        self.to_tensor = to_tensor
+        self.outputs = OUTPUTS if outputs is None else tuple(key for key in OUTPUTS if key == "image" or key in outputs)
+        config = {"base_dataset": base_dataset_fingerprint(base_dataset_name), "volume_dimensions": list(volume_dimensions), "size": size,
+                  "fg_classes": list(fg_classes), "fg_positions": np.asarray(fg_positions).tolist(),
+                  "bg_classes": list(bg_classes), "bg_amount": bg_amount, "bg_bbox": list(bg_bbox),
+                  "position_translation": position_translation, "position_noise": position_noise,
+                  "element_depth": element_depth, "fine_segment": fine_segment, "start_seed": start_seed,
+                  "outputs": list(self.outputs), "cache_version": CACHE_VERSION}
+        self.config_key = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        self.output_path = os.path.join(output_path, self.config_key)
+
+        # Opening the stored volumes, or generating them volume by volume (and chunk by chunk) into the memory maps
+        if os.path.isfile(os.path.join(self.output_path, "meta.json")):
+            self.arrays = self.load()
+            return
+        base_dataset = load_dataset(base_dataset_name)
+        temp_path = "{}.tmp{}".format(self.output_path, os.getpid())
+        os.makedirs(temp_path, exist_ok=True)
+        num_fg = len(fg_classes)
+        specs = {"image": (np.float32, volume_dimensions), "labelmap": (LABELMAP_DTYPE, volume_dimensions),
+                 "bboxes": (np.float64, (num_fg, 6)), "bg_labelmap": (BG_LABELMAP_DTYPE, volume_dimensions)}
+        arrays = {key: np.lib.format.open_memmap(os.path.join(temp_path, key + ".npy"), mode="w+", dtype=dtype, shape=(size, *shape))
+                  for key, (dtype, shape) in specs.items() if key in self.outputs}
+        for idx in range(size):
+            generate_volume(idx + start_seed, base_dataset, self.volume_dimensions, fg_classes, fg_positions,
+                            position_translation, position_noise, bg_classes, bg_amount, bg_bbox, element_depth,
+                            fine_segment, outputs=self.outputs, chunk_depth=chunk_depth,
+                            out={key: array[idx] for key, array in arrays.items()})
+        for array in arrays.values():
+            array.flush()
+        del arrays
+        with open(os.path.join(temp_path, "meta.json"), "w") as meta_file:
+            json.dump(config, meta_file)
+
+        # Moving the arrays in place; if another process stored them in the meantime, keeping theirs
+        try:
+            os.replace(temp_path, self.output_path)
+        except OSError:
+            shutil.rmtree(temp_path)
+        self.arrays = self.load()
+
+    def load(self):
+        """Opens the stored arrays, read-only."""
+        return {key: np.load(os.path.join(self.output_path, key + ".npy"), mmap_mode="r") for key in self.outputs}
+
+    def get_batch(self, idxs):
+        """Gets a batch of volumes, read from disk as a single gather per output (a copy of a view for slices).
+
+        :param idxs: a slice or a list of indexes.
+        :return: a dict of stacked arrays, or tensors if `to_tensor`.
+        """
+        batch = {key: np.array(array[idxs]) for key, array in self.arrays.items()}
+        return batch_to_tensors(batch) if self.to_tensor else batch
+
+    def __getitem__(self, idx):
+        # Slices and lists of indexes (e.g. from CloStObBatchSampler) return whole batches
+        if isinstance(idx, (slice, list)):
+            return self.get_batch(idx)
+        return {key: value[0] for key, value in self.get_batch([idx]).items()}
+
+    def __getitems__(self, idxs):
+        """Gets a whole batch at once (see `get_batch`), as a `CollatedBatch` for either `collate_batch` or the default
+        collate function."""
+        return CollatedBatch(self.get_batch(list(idxs)))
+
+    def __len__(self):
+        return self.size
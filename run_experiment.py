@@ -17,8 +17,8 @@ import torchvision as tv
 from train import train_model
 from unet import UNet
 from utils import targetToTensor, multi_logical_or, create_relational_kernel
-from datasets.clostob.clostob_dataset import CloStObDataset
-from spatial_loss import SpatialPriorErrorSegmentation, RelationalMapOverlap
+from datasets.clostob.clostob_dataset import CloStObDataset, collate_batch
+from spatial_loss import SpatialPriorErrorSegmentation, RelationalMapOverlap, CritClassReassembler
 
 
 class limitedCrossEntropyLoss(torch.nn.CrossEntropyLoss):
@@ -79,8 +79,8 @@ def run_experiment(model_seed, dataset_split_seed, dataset, relational_criterion
     test_set_size = dataset_size - (train_set_size + val_set_size)  # to discard
     train_set, val_set, _ = random_split(dataset, (train_set_size, val_set_size, test_set_size), generator=dataset_split_rng)
     # Preparing dataloaders
-    data_loaders = {"train": DataLoader(train_set, batch_size=batch_size, num_workers=2),
-                    "val": DataLoader(val_set, batch_size=batch_size, num_workers=2)}
+    data_loaders = {"train": DataLoader(train_set, batch_size=batch_size, num_workers=2, collate_fn=collate_batch),
+                    "val": DataLoader(val_set, batch_size=batch_size, num_workers=2, collate_fn=collate_batch)}
 
     # Counting output classes
     if crit_classes is not None:
@@ -127,6 +127,9 @@ if __name__ == "__main__":
         dataset_split_seed = int(sys.argv[5])
         alpha = float(sys.argv[6])
         current_config=sys.argv[7]
+    # Convolution backend of the RMO criterion (see `RMO_BACKENDS`); "auto" and "fft" are faster, but not bitwise
+    # reproducible against the direct convolution
+    rmo_backend = sys.argv[8] if len(sys.argv) > 8 else "direct"
         
     # Setting the image dimensions in advance
     image_dimensions = [160,160]
@@ -178,10 +181,11 @@ if __name__ == "__main__":
     if len(crit_classes) == (len(fg_classes))+1:
         crit_classes = None
 
-    # Preparing the relations
+    # Preparing the relations; both criterions share the reassembled outputs of each batch
+    reassembler = CritClassReassembler(len(fg_classes), crit_classes) if crit_classes is not None else None
     relational_criterions = [SpatialPriorErrorSegmentation(graph_relations, image_dimensions=image_dimensions,
-                                                            num_classes=len(fg_classes), crit_classes=crit_classes),
-                            RelationalMapOverlap(map_relations, num_classes=len(fg_classes), crit_classes=crit_classes, device="cuda")]
+                                                            num_classes=len(fg_classes), crit_classes=crit_classes, reassembler=reassembler),
+                            RelationalMapOverlap(map_relations, num_classes=len(fg_classes), crit_classes=crit_classes, device="cuda", reassembler=reassembler, backend=rmo_backend)]
     relational_criterions_labels = ["CSPE", "RMO"]
     if type(relational_criterion_idx) is int:
         rc_label = relational_criterions_labels[relational_criterion_idx]
@@ -220,7 +224,8 @@ if __name__ == "__main__":
                                 flattened=False,
                                 lazy_load=True,
                                 transform=transform,
-                                target_transform=target_transform)
+                                target_transform=target_transform,
+                                outputs=("image", "labelmap"))  # Segmentation only needs the labelmaps
 
     # Run experiment
     run_experiment(model_seed=model_seed, dataset_split_seed=dataset_split_seed,
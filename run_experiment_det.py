@@ -56,9 +56,9 @@ def run_experiment(model_seed, dataset_split_seed, dataset, test_dataset, image_
     train_set, val_set, _ = random_split(dataset, ((dataset_size*7)//10, (dataset_size*3)//10, 0), generator=dataset_split_rng)
     test_set = test_dataset
     # Preparing dataloaders
-    data_loaders = {"train": DataLoader(train_set, batch_size=batch_size, num_workers=2),
-                    "val": DataLoader(val_set, batch_size=batch_size, num_workers=2),
-                    "test": DataLoader(test_set, batch_size=batch_size, num_workers=2)}
+    data_loaders = {"train": DataLoader(train_set, batch_size=batch_size, num_workers=2, collate_fn=collate_batch),
+                    "val": DataLoader(val_set, batch_size=batch_size, num_workers=2, collate_fn=collate_batch),
+                    "test": DataLoader(test_set, batch_size=batch_size, num_workers=2, collate_fn=collate_batch)}
 
 
     # Initializing model
@@ -138,7 +138,7 @@ def run_experiment(model_seed, dataset_split_seed, dataset, test_dataset, image_
 
 
 
-from datasets.clostob.clostob_dataset import CloStObDataset
+from datasets.clostob.clostob_dataset import CloStObDataset, collate_batch
 from spatial_loss import SpatialPriorErrorDetection
 from collections import deque
 
@@ -199,7 +199,8 @@ if __name__ == "__main__":
                                                 flattened=False,
                                                 lazy_load=False,
                                                 transform=transform,
-                                                target_transform=target_transform)
+                                                target_transform=target_transform,
+                                                outputs=("image", "bboxes"))  # Detection training only needs the bounding boxes
                     
                     # Preparing the rotated part of the test set
                     rotated_fg_positions = deque(base_fg_positions)
@@ -4,11 +4,108 @@ Author
 ------
  * Mateus Riva (mateus.riva@telecom-paris.fr)
 """
-from math import isnan
+import weakref
+from math import isnan, log2
 
 import torch
 from torch import nn
 from torch.nn.functional import conv2d
+from torch.fft import rfft2, irfft2
+
+"""=================================================
+           CRITERION CLASSES REASSEMBLY
+================================================="""
+
+class CritClassReassembler:
+    def __init__(self, num_classes, crit_classes):
+        """Reassembles full outputs (B,num_classes+1,H,W) from the outputs of the criterion classes only, taking the
+        complementary (uncritical) classes from the ground truth as one-hot maps. One reassembler can be shared by
+        several spatial losses: the result for the last (output, truths) pair is kept, and returned again as long as
+        neither tensor was modified, so that losses and metrics of the same batch reassemble it once. Only weak
+        references to the pair are held, and the result is dropped as soon as the output is freed.
+
+        Args:
+            num_classes (int): number of foreground classes.
+            crit_classes (list): classes being used in the criterion, in the order of the output channels.
+        """
+        self.crit_classes = list(crit_classes)
+        self.uncrit_classes = [x for x in range(num_classes+1) if x not in crit_classes]
+        self.num_channels = num_classes + 1
+
+        # Channel permutation from the concatenation [output, uncritical one-hot maps] to the full output
+        permutation = torch.empty(self.num_channels, dtype=torch.long)
+        permutation[self.crit_classes] = torch.arange(len(self.crit_classes))
+        permutation[self.uncrit_classes] = torch.arange(len(self.uncrit_classes)) + len(self.crit_classes)
+        # Slot of each class among the uncritical one-hot maps; critical classes go to an extra, discarded slot
+        uncrit_slots = torch.full((self.num_channels,), len(self.uncrit_classes), dtype=torch.long)
+        uncrit_slots[self.uncrit_classes] = torch.arange(len(self.uncrit_classes))
+        self.indexes = {"permutation": permutation, "uncrit_slots": uncrit_slots,
+                        "crit_channels": torch.tensor(self.crit_classes, dtype=torch.long),
+                        "uncrit_channels": torch.tensor(self.uncrit_classes, dtype=torch.long)}
+
+        # Copies of the indexes per device, and the last results (dropped along with their input, see `keep`)
+        self.device_indexes = {}
+        self.last_uncrit_maps = None
+        self.last_result = None
+
+    def keep(self, name, tensor, entry):
+        """Keeps a result entry as attribute `name`, until `tensor` (the input it was computed from) is freed."""
+        setattr(self, name, entry)
+        weakref.finalize(tensor, self.release, name, entry)
+
+    def release(self, name, entry):
+        """Drops a result entry kept by `keep`, unless it was already replaced."""
+        if getattr(self, name) is entry:
+            setattr(self, name, None)
+
+    def get_indexes(self, device):
+        """Gets the precomputed indexes on a device."""
+        if device not in self.device_indexes:
+            self.device_indexes[device] = {name: index.to(device) for name, index in self.indexes.items()}
+        return self.device_indexes[device]
+
+    def get_uncrit_maps(self, truths, dtype):
+        """Gets the one-hot maps (B,U,H,W) of the uncritical classes in the truths, built with a single scatter."""
+        if self.last_uncrit_maps is not None:
+            last_truths, last_version, last_dtype, uncrit_maps = self.last_uncrit_maps
+            if last_truths() is truths and last_version == truths._version and last_dtype == dtype:
+                return uncrit_maps
+
+        slots = self.get_indexes(truths.device)["uncrit_slots"][truths.long()].unsqueeze(1)
+        one_hot = torch.zeros((truths.shape[0], len(self.uncrit_classes)+1, *truths.shape[1:]), dtype=dtype, device=truths.device)
+        uncrit_maps = one_hot.scatter_(1, slots, 1)[:, :len(self.uncrit_classes)]
+        self.keep("last_uncrit_maps", truths, (weakref.ref(truths), truths._version, dtype, uncrit_maps))
+        return uncrit_maps
+
+    def __call__(self, output, truths):
+        """Reassembles the full output of a batch.
+
+        When gradients are needed, the full output is gathered from the output and the uncritical maps; otherwise,
+        both are copied into a new tensor in place, without the intermediate concatenation.
+
+        Args:
+            output (torch.Tensor): output of the criterion classes (B,len(crit_classes),H,W).
+            truths (torch.Tensor): ground truth labelmaps (B,H,W).
+        """
+        grad = torch.is_grad_enabled() and output.requires_grad
+        if self.last_result is not None:
+            last_output, last_version, last_truths, last_truths_version, last_grad, full_output = self.last_result
+            if (last_output() is output and last_version == output._version and last_truths() is truths
+                    and last_truths_version == truths._version and last_grad == grad):
+                return full_output
+
+        indexes = self.get_indexes(output.device)
+        uncrit_maps = self.get_uncrit_maps(truths, output.dtype)
+        if grad:
+            full_output = torch.cat([output, uncrit_maps], dim=1).index_select(1, indexes["permutation"])
+        else:
+            full_output = torch.empty((output.shape[0], self.num_channels, *output.shape[2:]), dtype=output.dtype, device=output.device)
+            full_output.index_copy_(1, indexes["crit_channels"], output)
+            full_output.index_copy_(1, indexes["uncrit_channels"], uncrit_maps)
+
+        self.keep("last_result", output, (weakref.ref(output), output._version, weakref.ref(truths), truths._version, grad, full_output))
+        return full_output
+
 
 """=================================================
             CENTRAL SPATIAL PRIOR ERROR
@@ -24,52 +121,59 @@ class SpatialPriorError(nn.Module):
         super(SpatialPriorError, self).__init__()
 
         self.relations = relations
-    
+
+        # Compiling the relations into index tensors (R,) and (2,R) target offsets (dy, dx), for computing all errors at once
+        sources, targets, dys, dxs = zip(*relations) if len(relations) > 0 else ((), (), (), ())
+        self.rel_sources = torch.tensor(sources, dtype=torch.long)
+        self.rel_targets = torch.tensor(targets, dtype=torch.long)
+        self.rel_offsets = torch.tensor([dys, dxs], dtype=torch.float64).view(2, 1, -1)
+        # Copies of the compiled relations on each (device, dtype) they were used with
+        self.compiled_relations = {}
+
+    def get_compiled_relations(self, device, dtype):
+        """Gets the compiled relations (sources, targets, offsets) on a device, with offsets of a given dtype."""
+        key = (device, dtype)
+        if key not in self.compiled_relations:
+            self.compiled_relations[key] = (self.rel_sources.to(device), self.rel_targets.to(device),
+                                            self.rel_offsets.to(device=device, dtype=dtype))
+        return self.compiled_relations[key]
+
     def compute_errors(self, centroids_y, centroids_x):
         """Computes the errors per coordinate for a given set of centroids.
         Centroids must have be of shape (B,C) where B is the batch size and C
         is the number of classes.
-        """
-        # Computing loss per relation
-        if torch.cuda.is_available():
-            dy_all = torch.empty(len(self.relations), centroids_y.size()[0], device="cuda")
-            dx_all = torch.empty(len(self.relations), centroids_x.size()[0], device="cuda")
-        else:
-            dy_all = torch.empty(len(self.relations), centroids_y.size()[0])
-            dx_all = torch.empty(len(self.relations), centroids_x.size()[0])
 
-        for relation_index, relation in enumerate(self.relations):
-            i, j, dy_gt, dx_gt = relation
-            dy = centroids_y[:, i] - centroids_y[:, j]
-            dx = centroids_x[:, i] - centroids_x[:, j]
+        All relations are computed in a single gather-subtract-square pass over the whole batch.
+        Returns (R,B) errors for y and for x.
+        """
+        sources, targets, offsets = self.get_compiled_relations(centroids_y.device, centroids_y.dtype)
+        centroids = torch.stack([centroids_y, centroids_x])  # (2,B,C)
 
-            diff_y = dy - dy_gt
-            diff_x = dx - dx_gt
+        # Differences between the actual and expected offsets of each relation (2,B,R)
+        diffs = centroids[:, :, sources] - centroids[:, :, targets] - offsets
+        errors = torch.square(torch.nan_to_num(diffs, nan=1, posinf=1, neginf=1))
 
-            dy_error = torch.square(
-                torch.nan_to_num(diff_y, nan=1, posinf=1, neginf=1))
-            dx_error = torch.square(
-                torch.nan_to_num(diff_x, nan=1, posinf=1, neginf=1))
+        # Errors are returned per relation (2,R,B), in the default dtype
+        errors = errors.transpose(1, 2).to(torch.get_default_dtype())
+        return errors[0], errors[1]
 
-            dy_all[relation_index] = dy_error
-            dx_all[relation_index] = dx_error
-        
-        return dy_all, dx_all
 
+def get_coordinate_vectors(image_dimensions, device="cpu", dtype=torch.float32):
+    """Gets the normalized row (H,) and column (W,) coordinate vectors of an image shape.
 
-def get_coordinates_map(image_dimensions, device="cpu"):
+    Centroids are separable: the full (H,W) coordinate grids are never needed, only their two vectors."""
     if len(image_dimensions) == 2:  # 2-dimensional input (h x w)
         h, w = image_dimensions
     elif len(image_dimensions) == 4:  # 2-dimensional batch input (n x c x h x w)
         _, _, h, w = image_dimensions
     else:
-        raise ValueError("Image dimensions has shape {}, only 2 and 4 are accepted".format(image_dimensions.shape))
-    coordinates_map = torch.meshgrid([torch.arange(h), torch.arange(w)], indexing="ij")
-    coordinates_map = (coordinates_map[0].to(torch.device(device))/h, coordinates_map[1].to(torch.device(device))/w)  # normalizing
-    return coordinates_map
+        raise ValueError("Image dimensions has shape {}, only 2 and 4 are accepted".format(len(image_dimensions)))
+    coords_y = (torch.arange(h)/h).to(device=torch.device(device), dtype=dtype)  # normalizing
+    coords_x = (torch.arange(w)/w).to(device=torch.device(device), dtype=dtype)
+    return coords_y, coords_x
 
 class SpatialPriorErrorSegmentation(SpatialPriorError):
-    def __init__(self, relations, image_dimensions=None, num_classes=None, crit_classes=None, device="cpu"):
+    def __init__(self, relations, image_dimensions=None, num_classes=None, crit_classes=None, device="cpu", reassembler=None):
         """Spatial prior loss for segmentation tasks.
 
         Args:
@@ -77,15 +181,16 @@ class SpatialPriorErrorSegmentation(SpatialPriorError):
             image_dimensions (tuple or None): shape of input images. If None, computed on-the-fly.
             crit_classes (list): classes being used in the criterion. If len(crit_classes) < num_classes,
                 the complementary classes will be taken from the ground truth. Only used for metrics.
+            reassembler (CritClassReassembler or None): reassembler of the full outputs, possibly shared with other
+                losses. If None and crit_classes is given, a new one is made.
         """
         super(SpatialPriorErrorSegmentation, self).__init__(relations)
 
+        self.image_dimensions = image_dimensions
+        # Coordinate vectors, per (shape, device, dtype) of the outputs they were used with
+        self.coordinate_vectors = {}
         if image_dimensions is not None:
-            self.image_dimensions = image_dimensions
-            self.coordinates_map = get_coordinates_map(image_dimensions, device)
-        else:
-            self.image_dimensions = None
-            self.coordinates_map = None
+            self.get_coordinate_vectors(image_dimensions, torch.device(device), torch.get_default_dtype())
 
         if num_classes:
             self.threshold = nn.Threshold(1.0/num_classes, 0)
@@ -95,33 +200,30 @@ class SpatialPriorErrorSegmentation(SpatialPriorError):
         self.crit_classes = crit_classes
         if crit_classes is not None:
             self.uncrit_classes = [x for x in range(num_classes+1) if x not in crit_classes]
+            self.reassembler = reassembler if reassembler is not None else CritClassReassembler(num_classes, crit_classes)
 
-    def compute_centroids(self, output):
-        # Computing centroids
-        if self.image_dimensions is None:  # Initializing coordinates_map on-the-fly
-            self.coordinates_map = get_coordinates_map(output.size(), output.device)
-
-        # Sanity checking device
-        if self.coordinates_map[0].device != output.device:
-            self.coordinates_map = get_coordinates_map(output.size(), output.device)
-
-        coords_y, coords_x = self.coordinates_map  # Getting coordinates map
-
-
-        coords_y = coords_y.expand(output.size())  # Fitting to the batch shape
-        coords_x = coords_x.expand(output.size())
+    def get_coordinate_vectors(self, image_dimensions, device, dtype):
+        """Gets the coordinate vectors of an image shape (see `get_coordinate_vectors`), cached per (shape, device, dtype)."""
+        key = (tuple(image_dimensions[-2:]), device, dtype)
+        if key not in self.coordinate_vectors:
+            self.coordinate_vectors[key] = get_coordinate_vectors(image_dimensions[-2:], device, dtype)
+        return self.coordinate_vectors[key]
 
+    def compute_centroids(self, output):
+        # Getting the coordinate vectors of the output shape, device and dtype
+        coords_y, coords_x = self.get_coordinate_vectors(output.size(), output.device, output.dtype)
 
         # Thresholding with the defined threshold
         output_thresholded = self.threshold(output)
+        # Centroids are separable: row and column marginal sums (B,C,H) and (B,C,W), dotted with the coordinate vectors
+        row_sums = torch.sum(output_thresholded, dim=3)
+        col_sums = torch.sum(output_thresholded, dim=2)
         # The total sum will be used for norm
-        output_sum = torch.sum(output_thresholded, dim=[2, 3])
+        output_sum = torch.sum(row_sums, dim=2)
+
+        centroids_y = torch.matmul(row_sums, coords_y) / output_sum
+        centroids_x = torch.matmul(col_sums, coords_x) / output_sum
 
-        centroids_y = torch.sum(output_thresholded * coords_y,
-                                dim=[2, 3]) / output_sum
-        centroids_x = torch.sum(output_thresholded * coords_x,
-                                dim=[2, 3]) / output_sum
-        
         return centroids_y, centroids_x
 
     def forward(self, output, truths=None):
@@ -129,11 +231,7 @@ class SpatialPriorErrorSegmentation(SpatialPriorError):
         
         Output should be of format (B,C,H,W)"""
         if self.crit_classes is not None:
-            full_output = torch.empty((output.shape[0], max(max(self.crit_classes), max(self.uncrit_classes))+1, *output.shape[2:]), device=output.device)
-            for i, crit_class in enumerate(self.crit_classes):
-                full_output[:,crit_class] = output[:,i]
-            for i, uncrit_class in enumerate(self.uncrit_classes):
-                full_output[:,uncrit_class] = (truths==uncrit_class).double()
+            full_output = self.reassembler(output, truths)
         else:
             full_output = output
         
@@ -147,11 +245,7 @@ class SpatialPriorErrorSegmentation(SpatialPriorError):
     def compute_metric(self, output, truths):
         """Like forward, but it return the value per object"""
         if self.crit_classes is not None:
-            full_output = torch.empty((output.shape[0], max(max(self.crit_classes), max(self.uncrit_classes))+1, *output.shape[2:]), device=output.device)
-            for i, crit_class in enumerate(self.crit_classes):
-                full_output[:,crit_class] = output[:,i]
-            for i, uncrit_class in enumerate(self.uncrit_classes):
-                full_output[:,uncrit_class] = (truths==uncrit_class).double()
+            full_output = self.reassembler(output, truths)
         else:
             full_output = output
 
@@ -202,21 +296,95 @@ class SpatialPriorErrorDetection(SpatialPriorError):
              RELATIONAL MAP OVERLAP
 ================================================="""
 
+def group_relation_kernels(sources, kernels):
+    """Stacks the kernels of a set of relations for a single grouped convolution.
+
+    Relations are grouped by source class; each group is a convolution group with one input channel (its source map)
+    and one output channel per relation, padded with zero kernels to the size M of the largest group. Kernels are
+    zero-padded to a common odd size, offset so that a symmetric padding gives the same result as `padding="same"` with
+    each original kernel (which pads even kernels one pixel less before than after).
+
+    Args:
+        sources (list): source class of each relation.
+        kernels (list): kernel of each relation, as 2D tensors on the same device.
+
+    Returns:
+        group_sources (list): source class of each group (G).
+        group_kernels (torch.Tensor): stacked kernels (G*M,1,K,K').
+        relation_channels (torch.Tensor): output channel of each relation in the grouped convolution (R).
+    """
+    group_sources = list(dict.fromkeys(sources))
+    group_slots = {source: 0 for source in group_sources}
+    group_size = max(sources.count(source) for source in group_sources)
+    # Common odd kernel size
+    kernel_size = [max(kernel.size(dim) for kernel in kernels) // 2 * 2 + 1 for dim in range(2)]
+
+    group_kernels = torch.zeros((len(group_sources)*group_size, 1, *kernel_size), dtype=kernels[0].dtype, device=kernels[0].device)
+    relation_channels = []
+    for source, kernel in zip(sources, kernels):
+        channel = group_sources.index(source)*group_size + group_slots[source]
+        group_slots[source] += 1
+        offsets = [(kernel_size[dim]-1)//2 - (kernel.size(dim)-1)//2 for dim in range(2)]
+        group_kernels[channel, 0, offsets[0]:offsets[0]+kernel.size(0), offsets[1]:offsets[1]+kernel.size(1)] = kernel
+        relation_channels.append(channel)
+    return group_sources, group_kernels, torch.tensor(relation_channels, dtype=torch.long, device=kernels[0].device)
+
+
+RMO_BACKENDS = ("auto", "direct", "fft")
+# Above this ratio of direct (HW*K*K') to FFT (F*log2(F)) operation counts, "auto" convolves through FFTs
+FFT_COST_RATIO = 10
+
+
+def fast_fft_size(n):
+    """Gets the smallest 5-smooth integer (only 2, 3 and 5 as prime factors) not below n, on which FFTs are fast."""
+    while True:
+        m = n
+        for factor in (2, 3, 5):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return n
+        n += 1
+
+
+def get_fft_dimensions(image_dimensions, kernel_size):
+    """Gets the FFT dimensions for the linear (non-circular) convolution of an image (H,W) with a kernel (K,K')."""
+    return tuple(fast_fft_size(image_dimensions[dim] + kernel_size[dim] - 1) for dim in range(2))
+
+
+def select_convolution_backend(image_dimensions, kernel_size):
+    """Selects the faster convolution backend, "direct" or "fft", from the operation counts of each."""
+    fft_dimensions = get_fft_dimensions(image_dimensions, kernel_size)
+    direct_cost = image_dimensions[0]*image_dimensions[1] * kernel_size[0]*kernel_size[1]
+    fft_size = fft_dimensions[0]*fft_dimensions[1]
+    return "fft" if direct_cost > FFT_COST_RATIO * fft_size*log2(fft_size) else "direct"
+
+
 class RelationalMapOverlap(nn.Module):
-    def __init__(self, relations, num_classes=None, crit_classes=None, device="cpu") -> None:
+    def __init__(self, relations, num_classes=None, crit_classes=None, device="cpu", reassembler=None, backend="direct") -> None:
         """Relational Map Overlap loss class.
         
         Given a set of relationships, defined as a triplet `source, target, kernel`,
-        compute the RMO error for a given input labelmap."""
+        compute the RMO error for a given input labelmap. If crit_classes is given, the full outputs are reassembled
+        by `reassembler` (possibly shared with other losses; a new `CritClassReassembler` if None).
+
+        Relational maps are convolved either directly (the default) or through FFTs (`backend` in `RMO_BACKENDS`);
+        "auto" picks the faster one for each image size. FFT results only match direct ones up to rounding."""
         super(RelationalMapOverlap, self).__init__()
 
+        if backend not in RMO_BACKENDS:
+            raise ValueError("Unknown RMO backend {}, expected one of {}".format(backend, RMO_BACKENDS))
         self.device = device
+        self.backend = backend
 
         # Dismantle the tuple list to operate on
         self.rel_sources = [relation[0] for relation in relations]
         self.rel_targets = [relation[1] for relation in relations]
         self.rel_kernels = [relation[2].to(device) for relation in relations]  # Convert to device
         self.relations = [(source, target, kernel) for source, target, kernel in zip(self.rel_sources, self.rel_targets, self.rel_kernels)]  # Reassemble the tuple list
+        self.group_sources, self.group_kernels, self.relation_channels = group_relation_kernels(self.rel_sources, self.rel_kernels)
+        # Spectra of the kernels for each (image size, device, dtype) they were used with
+        self.kernel_spectra = {}
 
         # A division epsilon for empty maps
         self.epsilon = 1e-7
@@ -225,26 +393,60 @@ class RelationalMapOverlap(nn.Module):
         self.crit_classes = crit_classes
         if crit_classes is not None:
             self.uncrit_classes = [x for x in range(num_classes+1) if x not in crit_classes]
+            self.reassembler = reassembler if reassembler is not None else CritClassReassembler(num_classes, crit_classes)
+
+    def get_kernel_spectra(self, image_dimensions, device, dtype):
+        """Gets the spectra (G,M,F,F'//2+1) of the group kernels for images of a given size, on a device and dtype.
+
+        Kernels are flipped, as `conv2d` computes a cross-correlation, and transformed at the FFT dimensions of a
+        linear convolution, so that the circular convolution of the spectra does not wrap around."""
+        key = (tuple(image_dimensions), device, dtype)
+        if key not in self.kernel_spectra:
+            fft_dimensions = get_fft_dimensions(image_dimensions, self.group_kernels.shape[2:])
+            kernels = self.group_kernels.to(device=device, dtype=dtype).flip(2, 3)
+            spectra = rfft2(kernels, s=fft_dimensions)
+            self.kernel_spectra[key] = spectra.view(len(self.group_sources), -1, *spectra.shape[2:])
+        return self.kernel_spectra[key]
+
+    def convolve_fft(self, source_maps):
+        """Convolves source maps (B,G,H,W) with the group kernels through FFTs, as the grouped `conv2d` does.
+
+        Returns the (B,G*M,H,W) maps, cropped from the linear convolution as with a "same" padding."""
+        batch_size, num_groups, h, w = source_maps.size()
+        # FFTs are computed in at least single precision
+        dtype = torch.promote_types(source_maps.dtype, torch.float32)
+        spectra = self.get_kernel_spectra((h, w), source_maps.device, dtype)
+        fft_dimensions = get_fft_dimensions((h, w), self.group_kernels.shape[2:])
+
+        # Products of each source spectrum (B,G,1,F,F') with the spectra of its group kernels (G,M,F,F')
+        maps = irfft2(rfft2(source_maps.to(dtype), s=fft_dimensions).unsqueeze(2) * spectra, s=fft_dimensions)
+
+        # Cropping the "same" window from the linear convolution
+        top, left = self.group_kernels.size(2)//2, self.group_kernels.size(3)//2
+        maps = maps[..., top:top+h, left:left+w].reshape(batch_size, -1, h, w)
+        return maps.to(source_maps.dtype)
 
     def compute_all_RMOs(self, output, truths=None):
         """Compute the relational map overlap scores of a given labelmap."""
         # If only a few classes are part of the criterion, reassemble the full output
         if self.crit_classes is not None:
-            full_output = torch.empty((output.shape[0], max(max(self.crit_classes), max(self.uncrit_classes))+1, *output.shape[2:]), device=output.device)
-            for i, crit_class in enumerate(self.crit_classes):
-                full_output[:,crit_class] = output[:,i]
-            for i, uncrit_class in enumerate(self.uncrit_classes):
-                full_output[:,uncrit_class] = (truths==uncrit_class).double()
+            full_output = self.reassembler(output, truths)
         else:
             full_output = output
 
-        # Convolve all sources with their respective kernels
-        rel_maps = torch.stack([conv2d(
-                                    full_output[:, source].unsqueeze(1),    # Output maps of class `source` (B, 1, H, W)
-                                    kernel.view(1,1, *kernel.size()),       # Kernel of relationship (1,1,H',W')
-                                    padding="same")                         # Padding as same
-                                for source, _, kernel in self.relations]
-                               ).squeeze(2).permute(1,0,2,3)                 # Output of each conv is (B,1,H,W); output of stack is (R,B,1,H,W); final is (B,R,H,W)
+        # Convolve all sources with their respective kernels, as a single grouped convolution (one group per source)
+        backend = self.backend
+        if backend == "auto":
+            backend = select_convolution_backend(full_output.shape[2:], self.group_kernels.shape[2:])
+        if backend == "fft":
+            rel_maps = self.convolve_fft(full_output[:, self.group_sources])
+        else:
+            group_kernels = self.group_kernels.to(dtype=full_output.dtype)
+            rel_maps = conv2d(full_output[:, self.group_sources],                # Output maps of each source class (B,G,H,W)
+                              group_kernels,                                     # Kernels of each group (G*M,1,K,K')
+                              padding=(group_kernels.size(2)//2, group_kernels.size(3)//2),  # Odd kernels: padding as same
+                              groups=len(self.group_sources))                    # Output is (B,G*M,H,W)
+        rel_maps = rel_maps.index_select(1, self.relation_channels)         # Channels of each relation (B,R,H,W)
 
         # Normalise all relationship maps to [0..1]
         #   Note: this normalisation is not perfect, spec. due to shape effects as discussed in the paper, but it should
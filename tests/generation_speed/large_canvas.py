@@ -0,0 +1,39 @@
+"""Script for benchmarking the tiled generation of large CloStOb canvases, over canvas and tile sizes"""
+import os
+import sys
+import resource
+from time import perf_counter
+
+sys.path.append("/home/mriva/Recherche/PhD/SATANN/SATANN_synth")
+from datasets.clostob.clostob_dataset import load_dataset
+from datasets.clostob.clostob_canvas import generate_canvas
+
+if __name__ == "__main__":
+    canvas_sizes = [2048, 4096, 8192]
+    tile_sizes = [256, 512, 1024]
+    output_dir = "/tmp/clostob_canvas"
+
+    base_dataset = load_dataset("fashion")
+    group_config = {"group_dimensions": (160, 160),
+                    "fg_classes": [0, 1, 8],
+                    "fg_positions": [(0.65, 0.3), (0.65, 0.7), (0.35, 0.7)],
+                    "position_translation": 0.1,
+                    "position_noise": 0.05,
+                    "rescale_classes": [],
+                    "rescale_range": (1, 1),
+                    "occlusion_classes": [1],
+                    "occlusion_range": (5, 12),
+                    "bg_classes": [0],
+                    "bg_amount": 3,
+                    "bg_bbox": (0, 0, 160, 160),
+                    "fine_segment": True,
+                    "rng_scheme": "philox-v1"}
+
+    for canvas_size in canvas_sizes:
+        for tile_size in tile_sizes:
+            start = perf_counter()
+            canvas = generate_canvas(0, os.path.join(output_dir, "{}_{}".format(canvas_size, tile_size)), base_dataset,
+                                     (canvas_size, canvas_size), **group_config, tile_size=tile_size)
+            print("{0}x{0} canvas ({1} groups), {2}x{2} tiles: {3:.2f}s, peak RSS {4:.0f} MB".format(
+                  canvas_size, len(canvas["bboxes"]), tile_size, perf_counter() - start,
+                  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
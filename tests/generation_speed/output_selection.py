@@ -0,0 +1,52 @@
+"""Script for comparing generation and loading throughput with all outputs against task-specific outputs"""
+import sys
+from time import perf_counter
+
+from torch.utils.data import DataLoader
+
+sys.path.append("/home/mriva/Recherche/PhD/SATANN/SATANN_synth")
+from datasets.clostob.clostob_dataset import CloStObDataset, CloStObBatchSampler, collate_batch, OUTPUTS
+
+if __name__ == "__main__":
+    dataset_size = 4096
+    batch_size = 64
+
+    config = {"base_dataset_name": "fashion",
+              "image_dimensions": [160, 160],
+              "size": dataset_size,
+              "fg_classes": [0, 1, 8],
+              "fg_positions": [(0.65, 0.3), (0.65, 0.7), (0.35, 0.7)],
+              "position_translation": 0.5,
+              "position_noise": 0.1,
+              "bg_classes": [0],
+              "bg_amount": 3,
+              "fine_segment": True,
+              "to_tensor": True}
+
+    tasks = {"all outputs": OUTPUTS,
+             "segmentation": ("image", "labelmap"),
+             "detection": ("image", "bboxes")}
+
+    for task, outputs in tasks.items():
+        # Generation throughput (lazy dataset, whole batches)
+        lazy_dataset = CloStObDataset(**config, lazy_load=True, outputs=outputs)
+        lazy_dataset[:batch_size]  # Warming up
+        start = perf_counter()
+        for i in range(0, dataset_size, batch_size):
+            lazy_dataset[i:i+batch_size]
+        generation_time = perf_counter() - start
+
+        # Loading throughput (preloaded dataset, through a DataLoader)
+        start = perf_counter()
+        preloaded_dataset = CloStObDataset(**config, lazy_load=False, outputs=outputs)
+        preload_time = perf_counter() - start
+        data_loader = DataLoader(preloaded_dataset, sampler=CloStObBatchSampler(preloaded_dataset, batch_size, shuffle=True),
+                                 batch_size=None, collate_fn=collate_batch)
+        start = perf_counter()
+        for batch in data_loader:
+            batch = {key: value.clone() for key, value in batch.items()}  # Stand-in for the transfer to the device
+        loading_time = perf_counter() - start
+        batch_bytes = sum(value.nelement() * value.element_size() for value in batch.values()) / len(batch["image"])
+
+        print("{}: generation {:.1f} samples/s, preloading {:.2f}s, loading {:.1f} samples/s, {:.0f} bytes/sample".format(
+              task, dataset_size/generation_time, preload_time, dataset_size/loading_time, batch_bytes))
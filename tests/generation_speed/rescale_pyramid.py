@@ -0,0 +1,53 @@
+"""Script for benchmarking rescale augmentation, exact (on-the-fly) against the quantized scale pyramid"""
+import sys
+from time import perf_counter
+
+import numpy as np
+
+sys.path.append("/home/mriva/Recherche/PhD/SATANN/SATANN_synth")
+from datasets.clostob.clostob_dataset import CloStObDataset, load_dataset
+
+if __name__ == "__main__":
+    dataset_size = 2000
+    batch_size = 256
+    pyramid_levels = [5, 9, 17]
+    cache_dir = "/tmp/clostob_cache"
+
+    config = {"base_dataset_name": "fashion",
+              "image_dimensions": [160, 160],
+              "size": dataset_size,
+              "fg_classes": [0, 1, 8],
+              "fg_positions": [(0.65, 0.3), (0.65, 0.7), (0.35, 0.7)],
+              "position_translation": 0.1,
+              "position_noise": 0.05,
+              "bg_classes": [0],
+              "bg_amount": 3,
+              "rescale_classes": [0, 1, 8],
+              "rescale_range": (0.7, 1.3),
+              "fine_segment": True,
+              "lazy_load": True}
+
+    # Exact mode: every element is rescaled on the fly
+    exact_dataset = CloStObDataset(**config)
+    start = perf_counter()
+    for i in range(0, dataset_size, batch_size):
+        exact_dataset.generate_batch(range(i, min(i+batch_size, dataset_size)))
+    exact_time = perf_counter() - start
+    print("Exact: {:.1f} samples/s".format(dataset_size/exact_time))
+
+    for levels in pyramid_levels:
+        # Building (or loading from the cache) the pyramid
+        load_dataset.cache_clear()
+        start = perf_counter()
+        pyramid_dataset = CloStObDataset(**config, rescale_levels=levels, cache_dir=cache_dir)
+        build_time = perf_counter() - start
+
+        start = perf_counter()
+        for i in range(0, dataset_size, batch_size):
+            pyramid_dataset.generate_batch(range(i, min(i+batch_size, dataset_size)))
+        pyramid_time = perf_counter() - start
+
+        # Quantization error against the exact scales, on the same seeds
+        image_errors = [np.abs(exact_dataset.generate_batch([i])["image"] - pyramid_dataset.generate_batch([i])["image"]).mean() for i in range(100)]
+        print("Pyramid, {} levels: {:.1f} samples/s ({:.1f}x), built/loaded in {:.2f}s, mean abs. pixel error {:.3f}".format(
+              levels, dataset_size/pyramid_time, exact_time/pyramid_time, build_time, np.mean(image_errors)))
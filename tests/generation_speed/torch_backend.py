@@ -0,0 +1,46 @@
+"""Script for benchmarking the numpy and torch batch compositors, over several torch thread counts"""
+import sys
+from time import perf_counter
+
+import torch
+
+sys.path.append("/home/mriva/Recherche/PhD/SATANN/SATANN_synth")
+from datasets.clostob.clostob_dataset import CloStObDataset
+
+if __name__ == "__main__":
+    dataset_size = 2048
+    batch_size = 256
+    thread_counts = [1, 2, 4, 8]
+
+    config = {"base_dataset_name": "fashion",
+              "image_dimensions": [160, 160],
+              "size": dataset_size,
+              "fg_classes": [0, 1, 8],
+              "fg_positions": [(0.65, 0.3), (0.65, 0.7), (0.35, 0.7)],
+              "position_translation": 0.1,
+              "position_noise": 0.05,
+              "bg_classes": [0],
+              "bg_amount": 3,
+              "rescale_classes": [8],
+              "rescale_range": (0.8, 1.2),
+              "rescale_levels": 9,
+              "occlusion_classes": [1],
+              "occlusion_range": (5, 12),
+              "fine_segment": True,
+              "to_tensor": True,
+              "lazy_load": True,
+              "rng_scheme": "philox-v1"}
+    datasets = {backend: CloStObDataset(**config, backend=backend) for backend in ["numpy", "torch"]}
+
+    # Both compositors give the very same tensors
+    numpy_batch, torch_batch = datasets["numpy"].get_batch(range(batch_size)), datasets["torch"].get_batch(range(batch_size))
+    assert all(torch.equal(numpy_batch[key], torch_batch[key]) for key in numpy_batch)
+
+    for num_threads in thread_counts:
+        torch.set_num_threads(num_threads)
+        for backend, dataset in datasets.items():
+            dataset.get_batch(range(batch_size))  # Warm-up
+            start = perf_counter()
+            for i in range(0, dataset_size, batch_size):
+                dataset.get_batch(range(i, min(i+batch_size, dataset_size)))
+            print("{} threads, {} backend: {:.1f} samples/s".format(num_threads, backend, dataset_size/(perf_counter() - start)))
@@ -0,0 +1,39 @@
+"""Script for benchmarking the generation of 3D CloStOb volumes and their streaming from disk to UNet3D"""
+import sys
+from time import perf_counter
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.append("/home/mriva/Recherche/PhD/SATANN/SATANN_synth")
+from datasets.clostob.clostob_dataset import CloStObBatchSampler, collate_batch
+from datasets.clostob.clostob_volume import VolumeCloStObDataset
+from unet import UNet3D
+
+if __name__ == "__main__":
+    dataset_size = 500
+    batch_size = 4
+    output_path = "/tmp/clostob_volumes"
+
+    start = perf_counter()
+    dataset = VolumeCloStObDataset("fashion", (64, 128, 128), dataset_size, output_path,
+                                   fg_classes=[0, 1, 8], fg_positions=[(0.3, 0.3, 0.3), (0.5, 0.6, 0.6), (0.7, 0.3, 0.7)],
+                                   bg_classes=[0], bg_amount=6, position_translation=0.2, position_noise=0.1,
+                                   element_depth=8, fine_segment=True, to_tensor=True, outputs=("image", "labelmap"))
+    print("Generated (or opened) {} volumes in {:.2f}s".format(dataset_size, perf_counter() - start))
+
+    data_loader = DataLoader(dataset, batch_size=None, sampler=CloStObBatchSampler(dataset, batch_size, shuffle=True),
+                             num_workers=2, collate_fn=collate_batch)
+    start = perf_counter()
+    for batch in data_loader: pass
+    print("Streamed {:.1f} volumes/s from disk".format(dataset_size / (perf_counter() - start)))
+
+    # A few UNet3D training steps on streamed volumes
+    model = UNet3D(1, dataset.number_of_classes)
+    optimizer = torch.optim.Adam(model.parameters())
+    for step, batch in zip(range(5), data_loader):
+        optimizer.zero_grad()
+        loss = torch.nn.functional.cross_entropy(model(batch["image"]), batch["labelmap"].long())
+        loss.backward()
+        optimizer.step()
+        print("Step {}: loss {:.4f}".format(step, loss.item()))
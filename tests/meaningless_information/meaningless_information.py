@@ -2,7 +2,6 @@
 import os, sys
 from glob import glob
 
-import numpy as np
 import matplotlib.pyplot as plt
 
 import torch
@@ -81,22 +80,22 @@ if __name__=="__main__":
                 model.load_state_dict(torch.load(model_path))
                 model.eval()
 
-                for omission_class in omission_classes:
+                # Getting meaningless images for all omission sets, and running the model on them at once
+                test_batch = test_dataset.generate_meaningless_batch(range(test_set_size), omission_classes, add_bg_noise=False)
+                test_images = test_batch["image"].to(device="cuda")
+                with torch.set_grad_enabled(False):
+                    outputs = model(test_images).detach().cpu()
+                # Softmaxing alongside class dimension
+                outputs_softmax = softmax(outputs, dim=1).view(len(omission_classes), test_set_size, *outputs.shape[1:])
+                test_images = test_images.view(len(omission_classes), test_set_size, *test_images.shape[1:])
+
+                for omission_idx, omission_class in enumerate(omission_classes):
                     mkdir("/home/mriva/Recherche/PhD/SATANN/SATANN_synth/tests/meaningless_information/results_strict/dataset_{}/{}/omissions_{}".format(dataset_size, model_label, omission_class))
                     
                     # List of probability maps to obtain
-                    probability_maps = np.empty((test_set_size, *image_dimensions))
+                    probability_maps = outputs_softmax[omission_idx,:,1].numpy()
                     for test_idx in range(test_set_size):
-                        # Getting a meaningless image with a single reference
-                        test_image = test_dataset.generate_meaningless_image(idx=test_idx, omitted_classes=omission_class, add_bg_noise=False)["image"].to(device="cuda")
-
-                        # Running the model on the test image
-                        with torch.set_grad_enabled(False):
-                            output = model(test_image.unsqueeze(0)).detach().cpu()
-                        
-                        # Softmaxing alongside class dimension
-                        output_softmax = softmax(output, dim=1)
-                        probability_maps[test_idx] = output_softmax[0,1]
+                        test_image, output_softmax = test_images[omission_idx, test_idx], outputs_softmax[omission_idx, test_idx:test_idx+1]
 
                         # Showing current results
                         plt.subplot(121)
@@ -10,7 +10,7 @@ from torch.nn.functional import softmax
 import torchvision as tv
 
 sys.path.append("/home/mriva/Recherche/PhD/SATANN/SATANN_synth")
-from datasets.clostob.clostob_dataset import CloStObDataset
+from datasets.clostob.clostob_dataset import CloStObDataset, collate_batch
 from unet import UNet
 from metrics import precision, recall
 from utils import targetToTensor, mkdir
@@ -98,7 +98,7 @@ if __name__ == "__main__":
                 if initialization_path[-2:] == ".5": continue
 
                 # Preparing the data loader
-                data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=4, num_workers=2)
+                data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=4, num_workers=2, collate_fn=collate_batch)
 
                 # Loading the specified model
                 model_path = os.path.join(initialization_path, "best_model.pth")
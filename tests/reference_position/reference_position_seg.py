@@ -1,6 +1,5 @@
 """Script for producing sliding reference position precision and recall heatmaps"""
 from cmath import sqrt
-from math import floor
 import os, sys
 from glob import glob
 
@@ -103,10 +102,7 @@ if __name__ == "__main__":
                 # Note: CSO functions take "which" class, like '0' for shirt or '8' for bag
                 # While this test takes 1,2,3, hence the need for conversion
                 converted_class = fg_classes[reference_class-1]
-                shifts_anchors_set = [test_dataset.generate_reference_shifts(i, converted_class, element_shape=element_shape, stride=stride) for i in range(test_set_size)]
-                shifts_set = [item for sublist in shifts_anchors_set for item in sublist[0]]  # Flattening
-                anchors_set = [item for sublist in shifts_anchors_set for item in sublist[1]]  # Flattening
-                all_anchors = anchors_set[:(len(anchors_set)//test_set_size)]
+                all_anchors = test_dataset.reference_anchors(stride=stride, element_shape=element_shape)
 
                 # REFERENCE POSITION:
                 #   Getting test-time precision and recall per class, per anchor for all converged inits
@@ -124,32 +120,26 @@ if __name__ == "__main__":
                     model.load_state_dict(torch.load(model_path))
                     model.eval()
 
-                    # Running the model on the test data
-                    outputs, truths = [], []
-                    for item_pair in shifts_set:
-                        inputs = item_pair["image"].unsqueeze(0).to(device="cuda")
-                        with torch.set_grad_enabled(False):
-                            outputs.append(model(inputs).detach().cpu())
-                        truths.append(item_pair["labelmap"])
-                    
-                    outputs = torch.cat(outputs, dim=0)
-                    truths = torch.stack(truths)
-
-                    outputs_softmax = softmax(outputs, dim=1)  # Softmax outputs along class dimension
-                    outputs_argmax = outputs_softmax.argmax(dim=1)  # Argmax outputs along class dimension
-                
-                    # computing metrics for all classes
-                    for _class in crit_classes:
-                        class_precisions = precision(outputs_argmax, truths, _class)
-                        class_recalls = recall(outputs_argmax, truths, _class)
-
-                        for idx, (class_precision, anchor) in enumerate(zip(class_precisions, anchors_set)):
-                            current_idx = floor((idx/len(all_anchors))+(init_idx*test_set_size))
-                            precisions[_class][anchor][current_idx] = class_precision
-                        for idx, (class_recall, anchor) in enumerate(zip(class_recalls, anchors_set)):
-                            current_idx = floor((idx/len(all_anchors))+(init_idx*test_set_size))
-                            recalls[_class][anchor][current_idx] = class_recall
-                    
+                    # Running the model on the test data, one lazily generated batch of shifts at a time
+                    for i in range(test_set_size):
+                        for batch, anchors in test_dataset.iter_reference_shifts(i, converted_class, element_shape=element_shape, stride=stride):
+                            inputs = batch["image"].to(device="cuda")
+                            with torch.set_grad_enabled(False):
+                                outputs = model(inputs).detach().cpu()
+                            truths = batch["labelmap"]
+
+                            outputs_softmax = softmax(outputs, dim=1)  # Softmax outputs along class dimension
+                            outputs_argmax = outputs_softmax.argmax(dim=1)  # Argmax outputs along class dimension
+
+                            # computing metrics for all classes
+                            for _class in crit_classes:
+                                class_precisions = precision(outputs_argmax, truths, _class)
+                                class_recalls = recall(outputs_argmax, truths, _class)
+
+                                for class_precision, class_recall, anchor in zip(class_precisions, class_recalls, anchors):
+                                    precisions[_class][anchor][i+(init_idx*test_set_size)] = class_precision
+                                    recalls[_class][anchor][i+(init_idx*test_set_size)] = class_recall
+
                     #for item_pair, output_argmax, anchor in zip(shifts_set, outputs_argmax, anchors_set):
                     #    plt.subplot(121); plt.imshow(item_pair["image"][0].detach().cpu().numpy(), cmap="gray")
                     #    plt.subplot(122); plt.imshow(output_argmax.detach().cpu().numpy())
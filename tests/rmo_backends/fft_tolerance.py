@@ -0,0 +1,54 @@
+"""Script for checking the FFT backend of the relational map overlap against the direct convolution, and timing both"""
+import sys
+from math import pi
+from time import perf_counter
+
+import torch
+
+sys.path.append("/home/mriva/Recherche/PhD/SATANN/SATANN_synth")
+from spatial_loss import RelationalMapOverlap, select_convolution_backend
+from utils import create_relational_kernel
+
+if __name__ == "__main__":
+    batch_size = 8
+    image_sizes = [64, 112, 160]
+    slack = 14
+    repeats = 5
+    tolerances = {torch.float32: 1e-4, torch.float64: 1e-10}
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    for image_size in image_sizes:
+        # Relations of the experiments, with kernels scaled to the image size
+        map_relations = [(2, 1, create_relational_kernel(distance=0.4*image_size, angle=pi, distance_slack=slack)),
+                         (1, 2, create_relational_kernel(distance=0.4*image_size, angle=pi+pi, distance_slack=slack)),
+                         (3, 2, create_relational_kernel(distance=0.3*image_size, angle=pi/2, distance_slack=slack)),
+                         (2, 3, create_relational_kernel(distance=0.3*image_size, angle=pi/2 + pi, distance_slack=slack)),
+                         (3, 1, create_relational_kernel(distance=0.5*image_size, angle=(7/6)*pi, distance_slack=slack)),
+                         (1, 3, create_relational_kernel(distance=0.5*image_size, angle=(7/6)*pi - pi, distance_slack=slack))]
+        criteria = {backend: RelationalMapOverlap(map_relations, 3, device=device, backend=backend) for backend in ["direct", "fft"]}
+        auto_backend = select_convolution_backend((image_size, image_size), criteria["fft"].group_kernels.shape[2:])
+
+        # Both backends give the same scores and gradients, up to the tolerance of each dtype
+        for dtype, tolerance in tolerances.items():
+            output = torch.softmax(torch.randn(batch_size, 4, image_size, image_size, dtype=dtype, device=device), dim=1)
+            scores, grads = {}, {}
+            for backend, criterion in criteria.items():
+                x = output.clone().requires_grad_()
+                scores[backend] = criterion.compute_all_RMOs(x)
+                scores[backend].sum().backward()
+                grads[backend] = x.grad
+            score_error = (scores["direct"] - scores["fft"]).abs().max().item()
+            grad_error = (grads["direct"] - grads["fft"]).abs().max().item()
+            assert score_error < tolerance and grad_error < tolerance, (image_size, dtype, score_error, grad_error)
+            print("{}px, {}: max score error {:.2e}, max gradient error {:.2e}".format(image_size, dtype, score_error, grad_error))
+
+        output = torch.softmax(torch.randn(batch_size, 4, image_size, image_size, device=device), dim=1).requires_grad_()
+        for backend, criterion in criteria.items():
+            criterion(output).backward()  # Warm-up
+            start = perf_counter()
+            for _ in range(repeats):
+                criterion(output).backward()
+            if device == "cuda": torch.cuda.synchronize()
+            print("{}px ({}x{} kernels), {} backend{}: {:.2f} ms per forward+backward".format(
+                  image_size, *criterion.group_kernels.shape[2:], backend, " (auto)" if backend == auto_backend else "",
+                  (perf_counter() - start) / repeats * 1e3))
@@ -0,0 +1,32 @@
+"""Script for benchmarking the spatial prior error over growing relation graphs"""
+import sys
+from time import perf_counter
+
+import torch
+
+sys.path.append("/home/mriva/Recherche/PhD/SATANN/SATANN_synth")
+from spatial_loss import SpatialPriorErrorSegmentation
+
+if __name__ == "__main__":
+    batch_size = 16
+    image_dimensions = (160, 160)
+    relation_counts = [3, 30, 300]
+    repeats = 20
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    for num_relations in relation_counts:
+        # Random graph over enough classes for the relations
+        num_classes = max(4, int(num_relations**0.5) + 2)
+        generator = torch.Generator().manual_seed(0)
+        sources, targets = torch.randint(1, num_classes, (2, num_relations), generator=generator).tolist()
+        offsets = (torch.rand(num_relations, 2, generator=generator) - 0.5).tolist()
+        relations = [(source, target, dy, dx) for source, target, (dy, dx) in zip(sources, targets, offsets)]
+        criterion = SpatialPriorErrorSegmentation(relations, image_dimensions=image_dimensions, num_classes=num_classes, device=device)
+
+        output = torch.rand(batch_size, num_classes, *image_dimensions, device=device, requires_grad=True)
+        criterion(output).backward()  # Warm-up
+        start = perf_counter()
+        for _ in range(repeats):
+            criterion(output).backward()
+        if device == "cuda": torch.cuda.synchronize()
+        print("{} relations ({} classes): {:.2f} ms per forward+backward".format(num_relations, num_classes, (perf_counter() - start) / repeats * 1e3))
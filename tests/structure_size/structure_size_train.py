@@ -22,7 +22,7 @@ from train import train_model
 from unet import UNet
 from utils import targetToTensor, mkdir, plot_output, multi_logical_or
 from metrics import dice_score, count_connected_components
-from datasets.clostob.clostob_dataset import CloStObDataset
+from datasets.clostob.clostob_dataset import CloStObDataset, collate_batch
 from spatial_loss import SpatialPriorErrorSegmentation
 
 import matplotlib.pyplot as plt
@@ -130,9 +130,9 @@ def run_experiment(model_seed, dataset_split_seed, dataset, test_dataset, relati
     train_set, val_set, _ = random_split(dataset, (train_set_size, val_set_size, test_set_size), generator=dataset_split_rng)
     test_set = test_dataset
     # Preparing dataloaders
-    data_loaders = {"train": DataLoader(train_set, batch_size=batch_size, num_workers=2),
-                    "val": DataLoader(val_set, batch_size=batch_size, num_workers=2),
-                    "test": DataLoader(test_set, batch_size=batch_size, num_workers=2)}
+    data_loaders = {"train": DataLoader(train_set, batch_size=batch_size, num_workers=2, collate_fn=collate_batch),
+                    "val": DataLoader(val_set, batch_size=batch_size, num_workers=2, collate_fn=collate_batch),
+                    "test": DataLoader(test_set, batch_size=batch_size, num_workers=2, collate_fn=collate_batch)}
 
 
     # Initializing model
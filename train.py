@@ -139,7 +139,8 @@ def train_model(model, optimizer, scheduler, criterion, relational_criterions, r
                         outputs_argmax = outputs_softmax.argmax(dim=1)  # argmax is used for metrics
                     # Losses
                     if alpha < 1:
-                        crit_loss = criterion(outputs, targets)  # Most criterions (like cross entropy) expect raw outputs
+                        # Most criterions (like cross entropy) expect raw outputs; compact labelmaps are upcast for them
+                        crit_loss = criterion(outputs, targets if targets.is_floating_point() else targets.long())
                     else:
                         crit_loss = torch.tensor(0)
                     if alpha > 0: